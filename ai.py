@@ -1,16 +1,38 @@
 import discord
 from discord import Message
 from discord.ext import commands
-import requests
+import aiohttp
 import asyncio
+import base64
+import contextlib
+import contextvars
+import email.utils
+import hashlib
+import heapq
+import io
+import itertools
+import math
+import json
+import random
 import re
 import os
+import signal
+import sys
+import multiprocessing
 import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
-from flask import Flask
+from typing import NamedTuple
+from flask import Flask, Response, jsonify
 from supabase import create_client, Client
 from dotenv import load_dotenv
-import concurrent.futures
+
+# Pillow нужен для уменьшения картинок; без него в модель уходят исходные ссылки Discord
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # Загружаем .env файл, если он существует
 load_dotenv()
@@ -22,20 +44,306 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 TARGET_THREAD_ID = int(os.environ.get("TARGET_THREAD_ID", "0"))
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
 MODEL = os.environ.get("MODEL")
-ENDPOINT = "https://openrouter.ai/api/v1/chat/completions"
+ENDPOINT = os.environ.get("OPENROUTER_ENDPOINT", "https://openrouter.ai/api/v1/chat/completions")
+
+# Параметры HTTP-клиента OpenRouter: число одновременных запросов и таймауты по фазам (секунды)
+OPENROUTER_MAX_CONCURRENCY = int(os.environ.get("OPENROUTER_MAX_CONCURRENCY", "20"))
+OPENROUTER_CONNECT_TIMEOUT = float(os.environ.get("OPENROUTER_CONNECT_TIMEOUT", "10"))
+OPENROUTER_READ_TIMEOUT = float(os.environ.get("OPENROUTER_READ_TIMEOUT", "30"))
+OPENROUTER_TOTAL_TIMEOUT = float(os.environ.get("OPENROUTER_TOTAL_TIMEOUT", "60"))
+OPENROUTER_KEEPALIVE = float(os.environ.get("OPENROUTER_KEEPALIVE", "60"))
+
+# Устойчивость к сбоям OpenRouter: повторы с экспоненциальной задержкой, резервные модели,
+# размыкатель цепи и «хеджирование» (дублирующий запрос, если первый долго не отвечает)
+RETRY_BACKOFF_BASE = float(os.environ.get("RETRY_BACKOFF_BASE", "0.5"))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", "8"))
+FALLBACK_MODELS = [m.strip() for m in os.environ.get("FALLBACK_MODELS", "").split(",") if m.strip()]
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "0"))
+# Общий срок на запрос со всеми повторами и резервными моделями (секунды)
+OPENROUTER_REQUEST_DEADLINE = float(os.environ.get("OPENROUTER_REQUEST_DEADLINE", "90"))
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Потоковые ответы: первое сообщение после первого предложения, затем правки не чаще интервала
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_FIRST_CHUNK_CHARS = 200
+
+# Интервал обновления метрик состояния и замера задержки цикла событий (секунды)
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "1"))
+# Сколько самых крупных историй каналов показывать в метриках
+METRICS_TOP_CHANNELS = int(os.environ.get("METRICS_TOP_CHANNELS", "20"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metrics:
+    """
+    Минимальный реестр метрик в текстовом формате Prometheus.
+    Пишется из цикла событий бота, читается из потока Flask — поэтому под блокировкой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}    # имя -> (тип, описание)
+        self._values = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def clear(self, name: str):
+        """Удаляет все серии метрики (для метрик с меняющимся набором меток)."""
+        with self._lock:
+            for key in [key for key in self._values if key[0] == name]:
+                del self._values[key]
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self) -> tuple:
+        """Копия всех серий для передачи в другой процесс."""
+        with self._lock:
+            histograms = {key: [list(buckets), total, count]
+                          for key, (buckets, total, count) in self._histograms.items()}
+            return dict(self._values), histograms
+
+    def load(self, snapshot: tuple, **labels):
+        """Заменяет серии значениями из snapshot, добавляя к ним метки labels."""
+        values, histograms = snapshot
+        extra = tuple(labels.items())
+        with self._lock:
+            for (name, series), value in values.items():
+                self._values[(name, tuple(sorted(series + extra)))] = value
+            for (name, series), histogram in histograms.items():
+                self._histograms[(name, tuple(sorted(series + extra)))] = histogram
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{key}="{str(value)}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in sorted(self._meta.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for (metric, labels), (buckets, total, count) in self._histograms.items():
+                        if metric != name:
+                            continue
+                        for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                            le = f'le="{bound}"'
+                            lines.append(f"{name}_bucket{self._labels(labels, le)} {bucket_count}")
+                        le = 'le="+Inf"'
+                        lines.append(f"{name}_bucket{self._labels(labels, le)} {count}")
+                        lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                        lines.append(f"{name}_count{self._labels(labels)} {count}")
+                else:
+                    for (metric, labels), value in self._values.items():
+                        if metric == name:
+                            lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("aibot_mentions_total", "counter", "Обработанные реплики по итогу")
+metrics.describe("aibot_phase_seconds", "histogram", "Длительность фаз обработки упоминания")
+metrics.describe("aibot_mention_seconds", "histogram", "Полное время обработки упоминания")
+metrics.describe("aibot_upstream_requests_total", "counter", "Запросы к OpenRouter по статусу")
+metrics.describe("aibot_event_loop_lag_seconds", "gauge", "Задержка цикла событий бота")
+metrics.describe("aibot_queue_pending", "gauge", "Упоминания в очередях каналов")
+metrics.describe("aibot_queue_active_channels", "gauge", "Каналы, у которых идёт обработка")
+metrics.describe("aibot_upstream_in_flight", "gauge", "Запросы к OpenRouter в процессе")
+metrics.describe("aibot_upstream_concurrency_limit", "gauge", "Лимит одновременных запросов к OpenRouter")
+metrics.describe("aibot_circuit_open", "gauge", "Разомкнута ли цепь для модели (1 — да)")
+metrics.describe("aibot_supabase_queue_depth", "gauge", "Строки в очереди записи Supabase")
+metrics.describe("aibot_supabase_rows_written", "counter", "Строки, записанные в Supabase")
+metrics.describe("aibot_supabase_rows_dropped", "counter", "Строки, отброшенные очередью Supabase")
+metrics.describe("aibot_history_channels", "gauge", "Каналы с историей в памяти")
+metrics.describe("aibot_history_bytes", "gauge", "Оценка памяти историй всех каналов")
+metrics.describe("aibot_history_channel_bytes", "gauge", "Оценка памяти истории канала (самые крупные)")
+metrics.describe("aibot_history_evictions", "counter", "Вытесненные из памяти каналы")
+metrics.describe("aibot_cache_hits", "counter", "Попадания в кэш ответов")
+metrics.describe("aibot_cache_misses", "counter", "Промахи кэша ответов")
+metrics.describe("aibot_cache_entries", "gauge", "Записи в кэше ответов")
+metrics.describe("aibot_rate_limited_total", "counter", "Упоминания, отклонённые ограничителем, по уровню")
+metrics.describe("aibot_upstream_tokens_total", "counter", "Токены OpenRouter по модели и виду")
+metrics.describe("aibot_usage_rows_dropped", "counter", "Строки учёта токенов, отброшенные очередью Supabase")
+metrics.describe("aibot_shard_ready", "gauge", "Готов ли шард (1 — да)")
+metrics.describe("aibot_shard_latency_seconds", "gauge", "Задержка gateway шарда")
+
+# Текущий span упоминания: клиент OpenRouter пишет в него свои фазы
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+# Подписчики на завершённые span'ы: функция (span, outcome, total_seconds), например, бенчмарк
+SPAN_LISTENERS = []
+
+class MentionSpan:
+    """
+    Тайминги обработки одного упоминания по фазам.
+    По завершении попадают в гистограммы /metrics и в лог одной JSON-строкой.
+    """
+
+    def __init__(self, channel_id: int, messages: int = 1):
+        self.channel_id = channel_id
+        self.messages = messages
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def finish(self, outcome: str):
+        total = time.perf_counter() - self.started
+        for name, seconds in self.phases.items():
+            metrics.observe("aibot_phase_seconds", seconds, phase=name)
+        metrics.observe("aibot_mention_seconds", total)
+        metrics.inc("aibot_mentions_total", outcome=outcome)
+        for listener in SPAN_LISTENERS:
+            listener(self, outcome, total)
+        print(json.dumps({
+            "span": "mention",
+            "channel_id": str(self.channel_id),
+            "messages": self.messages,
+            "outcome": outcome,
+            "total_ms": round(total * 1000, 2),
+            "phases_ms": {name: round(seconds * 1000, 2) for name, seconds in self.phases.items()},
+        }, ensure_ascii=False))
+
+def record_phase(name: str, seconds: float):
+    """Добавляет время фазы в текущий span (если он есть)."""
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        span.record(name, seconds)
+
+# Режим запуска: single — один бот, sharded — AutoShardedBot в одном процессе,
+# multiprocess — SHARD_COUNT шардов, разложенных по WORKER_PROCESSES процессам
+RUN_MODE = os.environ.get("RUN_MODE", "single").lower()
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "0"))
+SHARD_IDS = os.environ.get("SHARD_IDS", "")
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+# Только интенты, нужные для ответов на упоминания (без участников и присутствия)
+MINIMAL_INTENTS = os.environ.get("MINIMAL_INTENTS", "1" if RUN_MODE != "single" else "0") == "1"
+# Через сколько секунд без обновления шард считается неживым
+SHARD_STALE_AFTER = float(os.environ.get("SHARD_STALE_AFTER", "30"))
+# Перезапуск упавших процессов: задержка растёт вдвое до WORKER_RESTART_BACKOFF_MAX;
+# процесс, проживший меньше WORKER_FAST_EXIT секунд WORKER_MAX_FAST_FAILURES раз подряд, больше не запускается
+WORKER_RESTART_BACKOFF = float(os.environ.get("WORKER_RESTART_BACKOFF", "5"))
+WORKER_RESTART_BACKOFF_MAX = float(os.environ.get("WORKER_RESTART_BACKOFF_MAX", "300"))
+WORKER_FAST_EXIT = float(os.environ.get("WORKER_FAST_EXIT", "60"))
+WORKER_MAX_FAST_FAILURES = int(os.environ.get("WORKER_MAX_FAST_FAILURES", "5"))
+# Сколько секунд ждать штатной остановки по SIGTERM (Render даёт 30 с до SIGKILL)
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "25"))
+
+# Состояние шардов для /health: shard_id -> {ready, latency, guilds, pid, updated}.
+# В режиме multiprocess заменяется общим словарём multiprocessing.Manager.
+SHARD_STATUS = {}
+# Снимки метрик рабочих процессов для /metrics: имя процесса -> Metrics.snapshot().
+# Заполняется только в режиме multiprocess; WORKER_NAME — имя текущего рабочего процесса.
+WORKER_METRICS = {}
+WORKER_NAME = None
+# Выставляется при остановке, чтобы супервизор не перезапускал завершающиеся процессы
+SHUTTING_DOWN = threading.Event()
+
 # Flask-приложение для поддержания работы бота на Render.com
 app = Flask(__name__)
 
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-
 @app.route('/')
 def home():
     return "Бот работает!", 200
 
+def shard_health() -> dict:
+    """Сводка готовности и задержки по всем шардам (из всех процессов)."""
+    now = time.time()
+    shards = {}
+    for shard_id, status in sorted(dict(SHARD_STATUS).items()):
+        alive = now - status["updated"] < SHARD_STALE_AFTER
+        shards[str(shard_id)] = {**status, "ready": status["ready"] and alive}
+    latencies = [status["latency"] for status in shards.values() if status["ready"]]
+    return {
+        "ready": bool(shards) and all(status["ready"] for status in shards.values()),
+        "shards": shards,
+        "guilds": sum(status["guilds"] for status in shards.values()),
+        "max_latency": max(latencies) if latencies else None,
+    }
+
+@app.route('/health')
+def health():
+    summary = shard_health()
+    return jsonify(summary), 200 if summary["ready"] else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    metrics.clear("aibot_shard_ready")
+    metrics.clear("aibot_shard_latency_seconds")
+    for shard_id, status in shard_health()["shards"].items():
+        metrics.set("aibot_shard_ready", int(status["ready"]), shard=shard_id)
+        metrics.set("aibot_shard_latency_seconds", status["latency"], shard=shard_id)
+    # В режиме multiprocess метрики обработки живут в рабочих процессах
+    for worker, snapshot in dict(WORKER_METRICS).items():
+        metrics.load(snapshot, worker=worker)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # Получаем ID треда из переменных окружения
 MAX_HISTORY_LENGTH = 10000
 MAX_RESPONSE_LENGTH = 1950
-MAX_RETRIES = 10
+# Длинный ответ делится на несколько сообщений, но не больше этого числа
+MAX_RESPONSE_MESSAGES = int(os.environ.get("MAX_RESPONSE_MESSAGES", "4"))
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "3"))
+MAX_COMPLETION_TOKENS = 600
+
+# Бюджет токенов на весь запрос (системный промпт + история + ответ).
+# CONTEXT_TOKEN_BUDGET переопределяет значение из таблицы для всех моделей.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "0"))
+DEFAULT_CONTEXT_BUDGET = 8000
+MODEL_CONTEXT_BUDGETS = {
+    "gemini": 32000,
+    "gpt-4o": 16000,
+    "claude": 16000,
+    "deepseek": 16000,
+    "qwen": 16000,
+    "llama": 8000,
+    "mistral": 8000,
+}
+
+# Сворачивание старых реплик в краткую сводку вместо их удаления
+HISTORY_SUMMARY = os.environ.get("HISTORY_SUMMARY", "0") == "1"
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "500"))
+
+# Общий лимит памяти на истории всех каналов и глубина подгрузки из Supabase
+HISTORY_MEMORY_LIMIT = int(float(os.environ.get("HISTORY_MEMORY_MB", "64")) * 1024 * 1024)
+HISTORY_REHYDRATE_LIMIT = int(os.environ.get("HISTORY_REHYDRATE_LIMIT", "40"))
 
 # Настройка Supabase
 supabase: Client = None
@@ -49,11 +357,79 @@ if SUPABASE_URL and SUPABASE_KEY:
 else:
     print("ПРЕДУПРЕЖДЕНИЕ: Не указаны URL или ключ Supabase. Сохранение сообщений будет отключено.")
 
-# Регулярное выражение для фильтрации запрещенного контента
-CONTENT_FILTERS = re.compile(
-    r'\b(суицид|самоубийств)\b',
-    flags=re.IGNORECASE
+# Очередь упоминаний: лимиты на канал и сервер, окно объединения всплеска упоминаний
+# (секунды; 0 — не объединять, каждое упоминание получает свой ответ)
+CHANNEL_QUEUE_LIMIT = int(os.environ.get("CHANNEL_QUEUE_LIMIT", "10"))
+GUILD_QUEUE_LIMIT = int(os.environ.get("GUILD_QUEUE_LIMIT", "30"))
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "0"))
+COALESCE_MAX_MESSAGES = int(os.environ.get("COALESCE_MAX_MESSAGES", "5"))
+
+# Ограничение частоты упоминаний (token bucket): запас BURST и пополнение PER_MINUTE в минуту.
+# Нулевой BURST отключает ограничение для своего уровня.
+RATE_LIMIT_USER_BURST = int(os.environ.get("RATE_LIMIT_USER_BURST", "3"))
+RATE_LIMIT_USER_PER_MINUTE = float(os.environ.get("RATE_LIMIT_USER_PER_MINUTE", "6"))
+RATE_LIMIT_CHANNEL_BURST = int(os.environ.get("RATE_LIMIT_CHANNEL_BURST", "10"))
+RATE_LIMIT_CHANNEL_PER_MINUTE = float(os.environ.get("RATE_LIMIT_CHANNEL_PER_MINUTE", "30"))
+RATE_LIMIT_GUILD_BURST = int(os.environ.get("RATE_LIMIT_GUILD_BURST", "30"))
+RATE_LIMIT_GUILD_PER_MINUTE = float(os.environ.get("RATE_LIMIT_GUILD_PER_MINUTE", "120"))
+# Сколько вёдер каждого уровня держать в памяти (давно неактивные вытесняются)
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "50000"))
+
+# Учёт токенов OpenRouter: таблица Supabase и квота на пользователя за окно (0 — без квоты)
+USAGE_TABLE = os.environ.get("USAGE_TABLE", "usage")
+USER_TOKEN_QUOTA = int(os.environ.get("USER_TOKEN_QUOTA", "0"))
+USER_QUOTA_WINDOW = float(os.environ.get("USER_QUOTA_WINDOW", "86400"))
+
+# Картинки: сколько брать из сообщения, до какого размера уменьшать и в каком формате отправлять
+VISION_MAX_IMAGES = int(os.environ.get("VISION_MAX_IMAGES", "4"))
+VISION_MAX_SIDE = int(os.environ.get("VISION_MAX_SIDE", "1024"))
+VISION_FORMAT = os.environ.get("VISION_FORMAT", "JPEG").upper()
+VISION_QUALITY = int(os.environ.get("VISION_QUALITY", "85"))
+VISION_MAX_DOWNLOAD = int(float(os.environ.get("VISION_MAX_DOWNLOAD_MB", "20")) * 1024 * 1024)
+VISION_CACHE_LIMIT = int(float(os.environ.get("VISION_CACHE_MB", "32")) * 1024 * 1024)
+# Сколько ID вложений помнить для повторных вопросов к той же картинке
+VISION_ATTACHMENT_CACHE_SIZE = int(os.environ.get("VISION_ATTACHMENT_CACHE_SIZE", "10000"))
+# Оценка токенов одной картинки для бюджета контекста
+VISION_IMAGE_TOKENS = int(os.environ.get("VISION_IMAGE_TOKENS", "800"))
+
+# Кэш ответов на повторяющиеся вопросы
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+# Сколько предыдущих реплик канала входит в ключ кэша помимо текущего вопроса.
+# По умолчанию — предыдущий обмен (вопрос и ответ), иначе «а почему?» из разных бесед совпадут
+RESPONSE_CACHE_CONTEXT_TURNS = int(os.environ.get("RESPONSE_CACHE_CONTEXT_TURNS", "2"))
+# Нечёткий режим: ключ по набору слов, а не по точному тексту
+RESPONSE_CACHE_FUZZY = os.environ.get("RESPONSE_CACHE_FUZZY", "0") == "1"
+
+# Параметры фоновой записи в Supabase
+SUPABASE_QUEUE_SIZE = int(os.environ.get("SUPABASE_QUEUE_SIZE", "5000"))
+SUPABASE_BATCH_SIZE = int(os.environ.get("SUPABASE_BATCH_SIZE", "50"))
+SUPABASE_FLUSH_INTERVAL = float(os.environ.get("SUPABASE_FLUSH_INTERVAL", "2"))
+SUPABASE_MAX_RETRIES = int(os.environ.get("SUPABASE_MAX_RETRIES", "5"))
+# Сколько секунд при остановке дописывать очередь; остаток отбрасывается
+SUPABASE_DRAIN_TIMEOUT = float(os.environ.get("SUPABASE_DRAIN_TIMEOUT", "10"))
+
+# Правила фильтрации контента: файл с правилами (перечитывается при изменении)
+CONTENT_RULES_FILE = os.environ.get(
+    "CONTENT_RULES_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "content_rules.json")
 )
+CONTENT_RULES_RELOAD_INTERVAL = float(os.environ.get("CONTENT_RULES_RELOAD_INTERVAL", "10"))
+
+# Правила по умолчанию, если файла нет
+DEFAULT_CONTENT_RULES = {
+    "terms": {
+        "self_harm": ["суицид", "самоубийств"]
+    },
+    "command_prefixes": "*#+",
+    "commands": {
+        "*": ["crime", "work", "rob", "daily", "bal", "balance", "slut"],
+        "#": ["ранг", "rank", "top", "level"],
+        "+": ["rep", "реп", "1"]
+    },
+    "max_mentions": 5
+}
 
 # Системный промпт безопасности
 SAFETY_PROMPT = """Ты профессиональный ассистент. Строгие правила:
@@ -82,81 +458,1990 @@ SAFETY_PROMPT = """Ты профессиональный ассистент. С
    - Если надо использовать заголовок, то используйте следующий формат: # Заголовок
    - Если надо использовать список, то используйте следующий формат: * пункт списка"""
 
+# Инструкции для запросов с изображениями
+VISION_PROMPT = """Ты профессиональный ассистент. Строгие правила:
+1. Запрещено обсуждать:
+   - Суицид, депрессию и методы самоповреждения
+   - Любые сериалы/фильмы о запрещенной тематике
+   - Расизм, нацистская символика, нацизм, фашизм.
+   - Обсуждения/упоминания/разговоры политического характера.
+   - Контент 18+ [ ники, аватарки, картинки ].
+   - Притеснения по политическим, религиозным/ориентационным и личным взглядам.
+   - Спам/Флуд/Оффтоп картинками, эмодзи, реакциями, символами и прочими вещами где-либо - запрещено.
+   - Запрещено спамить пингами любых участников сервера.
+   - Умышленное рекламирование своего или чужого ютуб-канала и прочего контента без разрешения @Volidorka или @Миса [ВПП] - запрещено
+   - Нельзя писать команды с префиксом * например: *crime, и так далее и еще # например #ранг и еще + например +1
+   - Все математические формулы и расчёты выводи в простом текстовом формате (например: P = F / A, без LaTeX или Markdown).
+2. При нарушении правил пользователем:
+   - Вежливо отказывайся продолжать разговор
+   - Не упоминай конкретные названия или имена
+   - Предлагай обратиться к специалистам"""
+
 def strip_think(text: str) -> str:
     """Удаляет блоки размышлений, заключённые в <think>...</think>."""
     return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
 
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора модели.
+    Байты UTF-8 / 4 дают близкую оценку и для латиницы, и для кириллицы.
+    """
+    return len(text.encode("utf-8")) // 4 + 4
+
+def estimate_prompt_tokens(messages: list) -> int:
+    """Оценка токенов запроса: текст всех сообщений и VISION_IMAGE_TOKENS на картинку."""
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                total += estimate_tokens(part["text"])
+            else:
+                total += VISION_IMAGE_TOKENS
+    return total
+
+def strip_leading_mentions(message: Message) -> str:
+    """
+    Исходный текст сообщения без упоминаний в начале. Упоминания ищутся в разметке
+    message.content (<@id>, <@!id>, <@&id>), поэтому пробелы в никах не мешают.
+    """
+    content = message.content
+    mentioned = set(message.raw_mentions) | set(message.raw_role_mentions)
+    while True:
+        match = re.match(r'\s*<@[!&]?(\d+)>', content)
+        if not match or int(match.group(1)) not in mentioned:
+            return content.lstrip()
+        content = content[match.end():]
+
+def context_budget_for(model: str) -> int:
+    """Бюджет токенов на запрос для модели."""
+    if CONTEXT_TOKEN_BUDGET > 0:
+        return CONTEXT_TOKEN_BUDGET
+    name = (model or "").lower()
+    for key, budget in MODEL_CONTEXT_BUDGETS.items():
+        if key in name:
+            return budget
+    return DEFAULT_CONTEXT_BUDGET
+
+def normalize_text(text: str) -> str:
+    """Нормализует текст для сравнения: регистр, ё, упоминания, пунктуация, пробелы."""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r'@\S+', ' ', text)
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return " ".join(text.split())
+
 def is_image_attachment(attachment: discord.Attachment) -> bool:
     """Проверяет, является ли файл изображением по расширению."""
     return attachment.filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif"))
 
+class FilterMatch(NamedTuple):
+    """Сработавшее правило фильтра и найденный фрагмент."""
+    rule: str
+    term: str
+
+class ContentFilter:
+    """
+    Фильтр запрещённого контента. Все термины правил компилируются один раз
+    в автомат Ахо-Корасик, и текст проверяется за один проход независимо от числа правил.
+    Термины совпадают с начала слова (как основы: «самоубийств» ловит «самоубийство»).
+    Текст и термины нормализуются одинаково: регистр, ё, латинские и цифровые
+    двойники кириллических букв, невидимые символы, пунктуация.
+    Для входящих сообщений дополнительно проверяются команды с префиксами и спам пингами.
+    """
+
+    HOMOGLYPHS = str.maketrans({
+        "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+        "o": "о", "p": "р", "t": "т", "x": "х", "y": "у", "u": "и",
+        "0": "о", "3": "з", "4": "ч", "6": "б", "ё": "е",
+        "\u00ad": None, "\u200b": None, "\u200c": None, "\u200d": None,
+        "\u2060": None, "\ufeff": None,
+    })
+    SEPARATORS = re.compile(r'[\W_]+')
+
+    def __init__(self, rules: dict, path: str = None):
+        self.path = path
+        self.mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+        self.command_prefixes = rules.get("command_prefixes", "")
+        self.commands = rules.get("commands", {})
+        self.max_mentions = int(rules.get("max_mentions", 0))
+        self._command_pattern = self._compile_commands(self.command_prefixes, self.commands)
+        self.size = 0
+        self._build(rules.get("terms", {}))
+
+    @staticmethod
+    def _compile_commands(prefixes: str, commands: dict):
+        """
+        Команда — это префикс в самом начале сообщения и слово только из букв
+        (или слово из списка commands), за которым идёт пробел или конец текста.
+        Так «*очень*», «задача #2» и «#general» в середине фразы командами не считаются.
+        Упоминания в начале сообщения отрезаются заранее (strip_leading_mentions).
+        commands: префикс -> список команд; префиксы без списка ловят любое слово.
+        """
+        variants = []
+        for prefix in prefixes:
+            words = commands.get(prefix)
+            if words:
+                word = "(?:" + "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)) + ")"
+            else:
+                word = r'[^\W\d_]+'
+            variants.append(re.escape(prefix) + word)
+        if not variants:
+            return None
+        return re.compile(
+            r'^\s*(' + "|".join(variants) + r')(?=\s|$)',
+            flags=re.IGNORECASE
+        )
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        text = text.lower().translate(cls.HOMOGLYPHS)
+        return " " + cls.SEPARATORS.sub(" ", text).strip() + " "
+
+    @staticmethod
+    def validate(rules):
+        """Проверяет структуру правил; при ошибке — ValueError с описанием."""
+        def word_lists(value, name: str):
+            if not isinstance(value, dict):
+                raise ValueError(f"«{name}» должен быть объектом")
+            for key, words in value.items():
+                if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+                    raise ValueError(f"«{name}.{key}» должен быть списком строк")
+
+        if not isinstance(rules, dict):
+            raise ValueError("правила должны быть JSON-объектом")
+        word_lists(rules.get("terms", {}), "terms")
+        word_lists(rules.get("commands", {}), "commands")
+        if not isinstance(rules.get("command_prefixes", ""), str):
+            raise ValueError("«command_prefixes» должен быть строкой")
+        max_mentions = rules.get("max_mentions", 0)
+        if not isinstance(max_mentions, int) or isinstance(max_mentions, bool):
+            raise ValueError("«max_mentions» должен быть целым числом")
+
+    @classmethod
+    def load(cls, path: str):
+        """Загружает правила из JSON-файла или берёт правила по умолчанию."""
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                rules = json.load(f)
+            cls.validate(rules)
+            return cls(rules, path)
+        return cls(DEFAULT_CONTENT_RULES)
+
+    def _build(self, terms: dict):
+        # Бор: переходы, суффиксные ссылки и выходы (длина термина, правило, термин)
+        goto = [{}]
+        outputs = [[]]
+        for rule, words in terms.items():
+            for word in words:
+                # Ведущий пробел привязывает термин к началу слова
+                key = " " + self.normalize(word).strip()
+                if key == " ":
+                    continue
+                state = 0
+                for char in key:
+                    nxt = goto[state].get(char)
+                    if nxt is None:
+                        nxt = len(goto)
+                        goto[state][char] = nxt
+                        goto.append({})
+                        outputs.append([])
+                    state = nxt
+                outputs[state].append(FilterMatch(rule, word))
+                self.size += 1
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in goto[state].items():
+                queue.append(nxt)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[nxt] = goto[link].get(char, 0)
+                outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        self._outputs = outputs
+
+    def _scan(self, text: str):
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                return outputs[state][0]
+        return None
+
+    def check(self, text: str, incoming: bool = False, mentions: int = 0, command_text: str = None):
+        """
+        Возвращает FilterMatch для первого сработавшего правила или None.
+        command_text — текст сообщения без упоминаний в начале для проверки команд
+        (по умолчанию text).
+        """
+        if incoming:
+            if self.max_mentions and mentions > self.max_mentions:
+                return FilterMatch("ping_spam", str(mentions))
+            if self._command_pattern:
+                command = self._command_pattern.search(text if command_text is None else command_text)
+                if command:
+                    return FilterMatch("command_prefix", command.group(1))
+        return self._scan(self.normalize(text))
+
+    def changed(self) -> bool:
+        """Изменился ли файл правил с момента загрузки."""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        return os.path.getmtime(self.path) != self.mtime
+
+class APIResponse:
+    """Ответ OpenRouter: статус, заголовки и тело (интерфейс как у requests.Response)."""
+
+    def __init__(self, status_code: int, text: str, headers: dict = None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+class OpenRouterError(Exception):
+    """Ошибка OpenRouter при потоковом запросе (HTTP-статус или error в SSE)."""
+
+    def __init__(self, status_code: int, text: str, headers: dict = None):
+        super().__init__(f"Статус код: {status_code}")
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+def retry_after_seconds(headers: dict):
+    """Значение заголовка Retry-After в секундах (число или HTTP-дата) или None."""
+    value = (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для одной модели. После CIRCUIT_FAILURE_THRESHOLD неудачных
+    запросов подряд (запрос со всеми повторами считается одной ошибкой) к модели
+    ничего не отправляется CIRCUIT_RESET_TIMEOUT секунд, затем пропускается одна
+    пробная попытка: успех замыкает цепь, ошибка снова размыкает.
+    """
+
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release(self):
+        """Попытка ничего не сказала о здоровье модели (например, 429 с Retry-After)."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.threshold:
+            if self.opened_at is None or self._probing:
+                print(f"Цепь разомкнута после {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+class OpenRouterClient:
+    """
+    Асинхронный клиент OpenRouter, работающий в цикле событий бота.
+    Держит общий пул keep-alive соединений и ограничивает число одновременных запросов.
+    """
+
+    def __init__(self, endpoint: str, api_key: str, concurrency: int = OPENROUTER_MAX_CONCURRENCY,
+                 connect_timeout: float = OPENROUTER_CONNECT_TIMEOUT,
+                 read_timeout: float = OPENROUTER_READ_TIMEOUT,
+                 total_timeout: float = OPENROUTER_TOTAL_TIMEOUT):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session: aiohttp.ClientSession = None
+        self.breakers = {}
+        # Модель -> время цикла событий, до которого она просила не обращаться (Retry-After)
+        self.blocked_until = {}
+        self.in_flight = 0
+
+    async def start(self):
+        """Создаёт сессию (и пул соединений) в текущем цикле событий."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                keepalive_timeout=OPENROUTER_KEEPALIVE,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                }
+            )
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def post(self, payload: dict):
+        """
+        Отправляет запрос на completion.
+        Возвращает APIResponse или None, если соединение не удалось.
+        """
+        await self.start()
+        started = time.perf_counter()
+        data = json.dumps(payload).encode("utf-8")
+        record_phase("payload_serialization", time.perf_counter() - started)
+        async with self._semaphore:
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                async with self._session.post(self.endpoint, data=data) as response:
+                    record_phase("upstream_ttfb", time.perf_counter() - started)
+                    result = APIResponse(response.status, await response.text(), dict(response.headers))
+                    metrics.inc("aibot_upstream_requests_total", status=str(response.status))
+                    return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc("aibot_upstream_requests_total", status="error")
+                print(f"Ошибка API запроса: {e!r}")
+                return None
+            finally:
+                self.in_flight -= 1
+                record_phase("upstream_total", time.perf_counter() - started)
+
+    async def stream(self, payload: dict, usage: dict = None):
+        """
+        Потоковый запрос (SSE). Асинхронный генератор фрагментов текста ответа.
+        Ошибки соединения пробрасываются, ошибки API — как OpenRouterError.
+        Если передан usage, в него записываются модель и поле usage из последнего фрагмента.
+        """
+        await self.start()
+        started = time.perf_counter()
+        data = json.dumps({**payload, "stream": True}).encode("utf-8")
+        record_phase("payload_serialization", time.perf_counter() - started)
+        async with self._semaphore:
+            self.in_flight += 1
+            started = time.perf_counter()
+            first = True
+            try:
+                async with self._session.post(self.endpoint, data=data) as response:
+                    metrics.inc("aibot_upstream_requests_total", status=str(response.status))
+                    if response.status != 200:
+                        raise OpenRouterError(response.status, await response.text(), dict(response.headers))
+                    async for raw_line in response.content:
+                        line = raw_line.decode("utf-8").strip()
+                        # Пустые строки и комментарии (": OPENROUTER PROCESSING") пропускаем
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            error = chunk["error"]
+                            code = error.get("code") if isinstance(error, dict) else None
+                            raise OpenRouterError(
+                                code if isinstance(code, int) else response.status,
+                                json.dumps(error, ensure_ascii=False)
+                            )
+                        if usage is not None and chunk.get("usage"):
+                            usage.update(chunk["usage"], model=chunk.get("model") or payload.get("model"))
+                        choices = chunk.get("choices") or []
+                        if choices:
+                            delta = (choices[0].get("delta") or {}).get("content")
+                            if delta:
+                                if first:
+                                    # Для потока «первый байт» — первый фрагмент текста
+                                    record_phase("upstream_ttfb", time.perf_counter() - started)
+                                    first = False
+                                yield delta
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError):
+                metrics.inc("aibot_upstream_requests_total", status="error")
+                raise
+            finally:
+                self.in_flight -= 1
+                record_phase("upstream_total", time.perf_counter() - started)
+
+    # --- Устойчивость: повторы, резервные модели, размыкатель цепи, хеджирование ---
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker()
+        return self.breakers[model]
+
+    @staticmethod
+    def _for_model(payload: dict, model: str) -> dict:
+        """Копия запроса для другой модели (Gemini не поддерживает штрафы за повторы)."""
+        body = {**payload, "model": model}
+        if "gemini" in model.lower():
+            body.pop("frequency_penalty", None)
+            body.pop("presence_penalty", None)
+        return body
+
+    def _attempts(self, payload: dict):
+        """
+        Модели по порядку: основная, затем FALLBACK_MODELS (без повторов).
+        Модели, ответившие 429 с Retry-After, пропускаются, пока не выйдет их срок.
+        """
+        models = [payload["model"]] + [m for m in FALLBACK_MODELS if m != payload["model"]]
+        for model in models:
+            wait = self.blocked_until.get(model, 0) - asyncio.get_running_loop().time()
+            if wait > 0:
+                print(f"Модель {model} ограничена по частоте ещё {wait:.0f} с, пропускаем")
+                continue
+            yield model, self._for_model(payload, model)
+
+    def _hold(self, model: str, headers: dict):
+        """Запоминает, сколько модель просила не присылать запросы (Retry-After)."""
+        retry_after = retry_after_seconds(headers) or 0
+        self.blocked_until[model] = asyncio.get_running_loop().time() + retry_after
+
+    @staticmethod
+    def _rate_limited(status_code: int, headers: dict) -> bool:
+        """429 с Retry-After — это лимит запросов, а не неисправность модели."""
+        return status_code == 429 and retry_after_seconds(headers) is not None
+
+    @staticmethod
+    def _retry_delay(model: str, attempt: int, headers: dict, deadline: float) -> float:
+        """
+        Задержка перед следующей попыткой к той же модели или None, если повторять
+        нельзя: Retry-After больше RETRY_BACKOFF_MAX (сразу берём резервную модель)
+        или задержка не укладывается в срок запроса.
+        """
+        if attempt >= MAX_RETRIES:
+            return None
+        retry_after = retry_after_seconds(headers)
+        if retry_after is not None and retry_after > RETRY_BACKOFF_MAX:
+            print(f"Модель {model} просит подождать {retry_after:.0f} с, переходим к резервной")
+            return None
+        delay = OpenRouterClient._backoff(attempt, headers)
+        if asyncio.get_running_loop().time() + delay >= deadline:
+            return None
+        return delay
+
+    @staticmethod
+    def _backoff(attempt: int, headers: dict = None) -> float:
+        """Экспоненциальная задержка со случайным разбросом; Retry-After имеет приоритет."""
+        retry_after = retry_after_seconds(headers)
+        if retry_after is not None:
+            return min(retry_after, RETRY_BACKOFF_MAX)
+        return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def _post_hedged(self, body: dict):
+        """Если ответ не пришёл за HEDGE_DELAY, отправляет дублирующий запрос и берёт первый успешный."""
+        if HEDGE_DELAY <= 0:
+            return await self.post(body)
+
+        primary = asyncio.create_task(self.post(body))
+        done, _ = await asyncio.wait({primary}, timeout=HEDGE_DELAY)
+        if done:
+            return primary.result()
+
+        pending = {primary, asyncio.create_task(self.post(body))}
+        result = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result is not None and result.status_code == 200:
+                        return result
+            return result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(self, payload: dict):
+        """
+        Запрос на completion с повторами и резервными моделями в пределах
+        OPENROUTER_REQUEST_DEADLINE. Возвращает APIResponse (успешный или
+        последний неуспешный) или None.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + OPENROUTER_REQUEST_DEADLINE
+        last = None
+        tried = False
+        for model, body in self._attempts(payload):
+            tried = True
+            breaker = self.breaker(model)
+            failed = False
+            for attempt in range(MAX_RETRIES + 1):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                if not breaker.allow():
+                    print(f"Модель {model} временно недоступна (цепь разомкнута)")
+                    break
+                try:
+                    response = await asyncio.wait_for(self._post_hedged(body), remaining)
+                except asyncio.TimeoutError:
+                    response = None
+                if response is not None and response.status_code not in RETRYABLE_STATUSES:
+                    # Ответ получен: сервис жив, даже если запрос неверный (4xx)
+                    breaker.record_success()
+                    return response
+                headers = response.headers if response is not None else None
+                if response is not None and self._rate_limited(response.status_code, headers):
+                    breaker.release()
+                    self._hold(model, headers)
+                else:
+                    failed = True
+                last = response if response is not None else last
+                delay = self._retry_delay(model, attempt, headers, deadline)
+                if delay is None:
+                    break
+                print(f"Повтор запроса к {model} через {delay:.1f} с (попытка {attempt + 2})")
+                await asyncio.sleep(delay)
+            if failed:
+                breaker.record_failure()
+            if loop.time() >= deadline:
+                print(f"Срок запроса к OpenRouter ({OPENROUTER_REQUEST_DEADLINE:g} с) истёк")
+                break
+        if not tried:
+            return APIResponse(429, "Все модели ограничены по частоте запросов")
+        return last
+
+    async def complete_stream(self, payload: dict, usage: dict = None):
+        """
+        Потоковый запрос с повторами и резервными моделями. Повторять можно только
+        до первого фрагмента: после него ошибка пробрасывается вызывающему.
+        Ожидание первого фрагмента со всеми повторами ограничено OPENROUTER_REQUEST_DEADLINE.
+        usage заполняется так же, как в stream.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + OPENROUTER_REQUEST_DEADLINE
+        last_error = None
+        tried = False
+        for model, body in self._attempts(payload):
+            tried = True
+            breaker = self.breaker(model)
+            failed = False
+            for attempt in range(MAX_RETRIES + 1):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                if not breaker.allow():
+                    print(f"Модель {model} временно недоступна (цепь разомкнута)")
+                    break
+                chunks = self.stream(body, usage)
+                try:
+                    first = await asyncio.wait_for(chunks.__anext__(), remaining)
+                except StopAsyncIteration:
+                    breaker.record_success()
+                    return
+                except OpenRouterError as e:
+                    await chunks.aclose()
+                    if e.status_code not in RETRYABLE_STATUSES:
+                        breaker.record_success()
+                        raise
+                    last_error, headers = e, e.headers
+                    if self._rate_limited(e.status_code, headers):
+                        breaker.release()
+                        self._hold(model, headers)
+                    else:
+                        failed = True
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    await chunks.aclose()
+                    last_error, headers = e, None
+                    failed = True
+                else:
+                    breaker.record_success()
+                    try:
+                        yield first
+                        async for chunk in chunks:
+                            yield chunk
+                    finally:
+                        await chunks.aclose()
+                    return
+
+                delay = self._retry_delay(model, attempt, headers, deadline)
+                if delay is None:
+                    break
+                print(f"Повтор потокового запроса к {model} через {delay:.1f} с (попытка {attempt + 2})")
+                await asyncio.sleep(delay)
+            if failed:
+                breaker.record_failure()
+            if loop.time() >= deadline:
+                print(f"Срок запроса к OpenRouter ({OPENROUTER_REQUEST_DEADLINE:g} с) истёк")
+                break
+
+        if not tried:
+            raise OpenRouterError(429, "Все модели ограничены по частоте запросов")
+        if last_error is None:
+            raise OpenRouterError(503, "Все модели временно недоступны")
+        raise last_error
+
+class ThinkStripper:
+    """Потоковый аналог strip_think: вырезает <think>...</think> из фрагментов по мере поступления."""
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+
+    @staticmethod
+    def _partial_tag(text: str, tag: str) -> int:
+        """Длина хвоста text, который может оказаться началом tag."""
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if tag.startswith(text[-size:]):
+                return size
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        """Принимает фрагмент, возвращает видимый текст, который уже можно показывать."""
+        self._buffer += chunk
+        visible = []
+        while True:
+            if self._inside:
+                index = self._buffer.find(self.CLOSE)
+                if index < 0:
+                    keep = self._partial_tag(self._buffer, self.CLOSE)
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                self._buffer = self._buffer[index + len(self.CLOSE):]
+                self._inside = False
+            else:
+                index = self._buffer.find(self.OPEN)
+                if index < 0:
+                    keep = self._partial_tag(self._buffer, self.OPEN)
+                    visible.append(self._buffer[:len(self._buffer) - keep])
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                visible.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(self.OPEN):]
+                self._inside = True
+        return "".join(visible)
+
+    def finish(self) -> str:
+        """Остаток буфера после окончания потока (незакрытый <think> отбрасывается)."""
+        rest = "" if self._inside else self._buffer
+        self._buffer = ""
+        return rest
+
+class ResponseFormatter:
+    """
+    Однопроходная постобработка ответа для Discord.
+
+    Разметку (**, *, __, _, ~~, ||, `, ```) не вырезает, а проверяет: незакрытые
+    маркеры закрываются, списки и заголовки остаются как есть. Текст длиннее
+    limit делится на части по безопасным границам (абзац, строка, предложение,
+    пробел); на разрыве открытые маркеры закрываются и заново открываются в
+    следующей части, в том числе блоки кода вместе с языком.
+
+    Работает инкрементально: feed() принимает фрагменты потока и возвращает уже
+    готовые части, preview() — текущую незаконченную часть, finish() — остаток.
+    """
+
+    PLAIN = re.compile(r'[^\n*_~|`@]+')
+    SENTENCE_END = re.compile(r'[.!?…](?=\s)')
+    # Язык блока кода: «python», «c++», «c#», «objective-c»
+    LANGUAGE = re.compile(r'[\w+#.-]{1,20}')
+    PAIRED = ("**", "__", "~~", "||")
+    MENTIONS = (("@everyone", "@\u200beveryone"), ("@here", "@\u200bhere"))
+    # Сколько символов после маркера нужно увидеть, чтобы его разобрать
+    LOOKAHEAD = 3
+    # Меньше не имеет смысла: на разрыве в часть должны поместиться закрывающие
+    # маркеры, а в следующую — открывающие (вместе с языком блока кода)
+    MIN_LIMIT = 100
+
+    def __init__(self, limit: int = MAX_RESPONSE_LENGTH):
+        self.limit = max(limit, self.MIN_LIMIT)
+        self._pending = ""
+        self._pieces = []
+        self._length = 0
+        self._stack = []
+        self._closers_length = 0
+        # (позиция в текущей части, стек маркеров после неё) — для разрыва в прошлом
+        self._events = []
+        self._base = ()
+        self._prev = "\n"
+        self._newlines = 0
+        self._ready = []
+
+    # Блок кода хранится в стеке как «```язык\n», инлайн-код — как «`», «``» или «```»
+    @staticmethod
+    def _closer(marker: str) -> str:
+        return "\n```" if marker.endswith("\n") else marker
+
+    def _closers(self, stack) -> str:
+        return "".join(self._closer(marker) for marker in reversed(stack))
+
+    @staticmethod
+    def _openers(stack) -> str:
+        return "".join(stack)
+
+    def feed(self, text: str) -> list:
+        """Принимает фрагмент текста, возвращает части, которые уже не изменятся."""
+        self._pending += text
+        self._scan(final=False)
+        return self._drain()
+
+    def finish(self) -> list:
+        """Разбирает остаток и возвращает последние части."""
+        self._scan(final=True)
+        self._emit("".join(self._pieces) + self._closers(self._stack))
+        self._pieces, self._length, self._events = [], 0, []
+        return self._drain()
+
+    def preview(self) -> str:
+        """Текущая незаконченная часть с временно закрытой разметкой."""
+        return ("".join(self._pieces) + self._closers(self._stack)).strip()
+
+    def _drain(self) -> list:
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _emit(self, text: str):
+        text = text.strip()
+        if text:
+            self._ready.append(text)
+
+    def _append(self, text: str):
+        """Добавляет обычный текст, при переполнении разрывая часть."""
+        while text:
+            room = self.limit - self._length - self._closers_length
+            if len(text) <= room:
+                self._pieces.append(text)
+                self._length += len(text)
+                return
+            if room > 0:
+                self._pieces.append(text[:room])
+                self._length += room
+                text = text[room:]
+            self._cut()
+
+    def _append_marker(self, marker: str, opens: str = None):
+        """
+        Маркеры разметки не разрываются посередине. opens — маркер, который будет
+        открыт: место под его закрытие резервируется сразу.
+        """
+        reserve = len(self._closer(opens)) if opens else 0
+        while self._length + len(marker) + reserve + self._closers_length > self.limit:
+            self._cut()
+        self._pieces.append(marker)
+        self._length += len(marker)
+
+    def _push(self, marker: str):
+        self._stack.append(marker)
+        self._closers_length += len(self._closer(marker))
+
+    def _pop(self) -> str:
+        marker = self._stack.pop()
+        self._closers_length -= len(self._closer(marker))
+        return marker
+
+    def _mark(self):
+        self._events.append((self._length, tuple(self._stack)))
+
+    def _boundary(self, text: str) -> int:
+        """Позиция разрыва: ищем во второй половине части, от крупных границ к мелким."""
+        half = len(text) // 2
+        in_code = bool(self._stack) and self._stack[-1].startswith("`")
+        index = text.rfind("\n\n", half)
+        if index < 0:
+            index = text.rfind("\n", half)
+        if index < 0 and not in_code:
+            ends = [match.end() for match in self.SENTENCE_END.finditer(text, half)]
+            index = ends[-1] if ends else -1
+        if index < 0:
+            index = text.rfind(" ", half)
+        return index if index > 0 else len(text)
+
+    def _state_at(self, position: int) -> tuple:
+        state = self._base
+        for event_position, stack in self._events:
+            if event_position > position:
+                break
+            state = stack
+        return state
+
+    def _cut(self):
+        text = "".join(self._pieces)
+        position = self._boundary(text)
+        state = self._state_at(position)
+        if position < len(text) and (
+                position + len(self._closers(state)) > self.limit
+                or len(self._openers(state)) + len(text) - position + self._closers_length >= self.limit):
+            # На границе открыто больше маркеров, чем помещается, или хвост не влезет
+            # в следующую часть — режем по текущему месту, где всё гарантированно помещается
+            position, state = len(text), tuple(self._stack)
+        self._emit(text[:position].rstrip() + self._closers(state))
+
+        tail = text[position:].lstrip(" \n")
+        opener = self._openers(state)
+        shift = len(text) - len(tail) - len(opener)
+        self._events = [(max(event_position - shift, len(opener)), stack)
+                        for event_position, stack in self._events if event_position > position]
+        self._base = state
+        self._pieces = [opener + tail]
+        self._length = len(self._pieces[0])
+
+    def _scan(self, final: bool):
+        text = self._pending
+        size = len(text)
+        index = 0
+        while index < size:
+            top = self._stack[-1] if self._stack else ""
+            if top.startswith("`"):
+                # Внутри кода разметка не действует: ищем только закрывающие кавычки
+                closer = "```" if top.startswith("```") else top
+                end = text.find(closer, index)
+                if end < 0:
+                    end = size if final else max(index, size - len(closer) + 1)
+                    self._append(text[index:end])
+                    index = end
+                    break
+                self._append(text[index:end])
+                self._append_marker(closer)
+                self._pop()
+                self._mark()
+                self._prev = closer[-1]
+                self._newlines = 0
+                index = end + len(closer)
+                continue
+
+            match = self.PLAIN.match(text, index)
+            if match:
+                self._append(match.group())
+                self._prev = text[match.end() - 1]
+                self._newlines = 0
+                index = match.end()
+                continue
+
+            char = text[index]
+            if char == "\n":
+                self._newlines += 1
+                # Больше одной пустой строки подряд не пропускаем
+                if self._newlines <= 2:
+                    self._append("\n")
+                self._prev = "\n"
+                index += 1
+                continue
+
+            if char == "@":
+                # Массовые упоминания обезвреживаем до подсчёта длины части
+                rest = text[index:index + 10]
+                if not final and len(rest) < 10 and any(
+                        mention.startswith(rest) for mention, _ in self.MENTIONS):
+                    break
+                for mention, safe in self.MENTIONS:
+                    if rest.startswith(mention):
+                        self._append(safe)
+                        index += len(mention)
+                        break
+                else:
+                    self._append(char)
+                    index += 1
+                self._prev = text[index - 1]
+                self._newlines = 0
+                continue
+
+            if not final and size - index <= self.LOOKAHEAD:
+                break
+
+            if char == "`":
+                shown = None
+                if text.startswith("```", index):
+                    end = text.find("\n", index + 3)
+                    closing = text.find("```", index + 3)
+                    if closing >= 0 and (end < 0 or closing < end):
+                        # ```код``` в одной строке — это инлайн-код
+                        marker = "```"
+                        index += 3
+                    elif end < 0 and not final:
+                        break
+                    else:
+                        end = size if end < 0 else end
+                        rest = text[index + 3:end].strip()
+                        if not rest or self.LANGUAGE.fullmatch(rest):
+                            marker, shown = f"```{rest}\n", f"```{rest}"
+                            index = end
+                        else:
+                            # После ``` сразу идёт код: переносим его на новую строку,
+                            # чтобы Discord не принял первое слово за язык
+                            marker = "```\n"
+                            index += 3
+                else:
+                    marker = "``" if text.startswith("``", index) else "`"
+                    index += len(marker)
+                self._append_marker(shown or marker, opens=marker)
+                self._push(marker)
+                self._mark()
+                self._prev = "`"
+                self._newlines = 0
+                continue
+
+            marker = text[index:index + 2]
+            if marker not in self.PAIRED:
+                marker = char if char in "*_" else ""
+            elif self._stack and self._stack[-1] == char and not self._prev.isspace():
+                # "***": сначала закрываем внутренний одинарный маркер
+                marker = char
+            following = text[index + len(marker):index + len(marker) + 1] if marker else ""
+            if (not marker
+                    # "* пункт" в начале строки — это список, а не курсив
+                    or (marker == "*" and self._prev == "\n" and following == " ")
+                    # snake_case и прочие подчёркивания внутри слова
+                    or (marker == "_" and self._prev.isalnum() and following.isalnum())
+                    # умножение в формулах вроде 2*3
+                    or (marker == "*" and self._prev.isdigit() and following.isdigit())):
+                self._append(char)
+                self._prev = char
+                self._newlines = 0
+                index += 1
+                continue
+
+            can_open = bool(following) and not following.isspace()
+            can_close = not self._prev.isspace()
+            if marker in self._stack and can_close:
+                # Закрываем маркер, попутно закрывая незакрытые внутри него
+                depth = len(self._stack) - self._stack[::-1].index(marker) - 1
+                self._append_marker(self._closers(self._stack[depth:]))
+                while len(self._stack) > depth:
+                    self._pop()
+                self._mark()
+            elif can_open:
+                self._append_marker(marker, opens=marker)
+                self._push(marker)
+                self._mark()
+            else:
+                self._append(marker)
+            self._prev = marker[-1]
+            self._newlines = 0
+            index += len(marker)
+        self._pending = text[index:]
+
+class SupabaseWriter:
+    """
+    Фоновая очередь записи в Supabase (write-behind).
+    Строки копятся в ограниченной очереди и вставляются пачками в отдельном потоке,
+    поэтому цикл событий бота никогда не ждёт сетевых запросов к базе.
+    """
+
+    def __init__(self, client: Client, table: str = "messages",
+                 queue_size: int = SUPABASE_QUEUE_SIZE,
+                 batch_size: int = SUPABASE_BATCH_SIZE,
+                 flush_interval: float = SUPABASE_FLUSH_INTERVAL,
+                 max_retries: int = SUPABASE_MAX_RETRIES):
+        self.client = client
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self._stopping = asyncio.Event()
+        self._task: asyncio.Task = None
+        self._batch = []
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, row: dict) -> bool:
+        """
+        Ставит строку в очередь, не блокируя вызывающего.
+        При переполнении вытесняется самая старая строка.
+        """
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 100 == 0:
+                    print(f"Очередь Supabase переполнена, отброшено строк: {self.dropped}")
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(row)
+        return True
+
+    async def close(self, timeout: float = SUPABASE_DRAIN_TIMEOUT):
+        """
+        Дописывает всё, что осталось в очереди, и останавливает фоновую задачу.
+        Если база не успевает за timeout секунд, недописанные строки отбрасываются.
+        """
+        self._stopping.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                lost = self.queue.qsize() + len(self._batch)
+                self.dropped += lost
+                print(f"Supabase не успел дописать очередь {self.table} за {timeout:.0f} с, "
+                      f"отброшено строк: {lost}")
+            self._task = None
+
+    async def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            self._batch = await self._collect()
+            if self._batch:
+                await self._flush(self._batch)
+            self._batch = []
+
+    async def _collect(self) -> list:
+        """Набирает пачку: до batch_size строк или до истечения flush_interval."""
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _insert(self, rows: list):
+        self.client.table(self.table).insert(rows).execute()
+
+    async def _flush(self, rows: list):
+        for attempt in range(self.max_retries):
+            try:
+                await asyncio.to_thread(self._insert, rows)
+                self.written += len(rows)
+                return
+            except Exception as e:
+                # Экспоненциальная задержка со случайным разбросом
+                delay = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"Ошибка при сохранении в Supabase (попытка {attempt + 1}): {str(e)}")
+                if attempt + 1 < self.max_retries:
+                    await asyncio.sleep(delay)
+        self.dropped += len(rows)
+        print(f"Не удалось сохранить {len(rows)} строк в Supabase, данные отброшены.")
+
+class ChannelHistory:
+    """
+    История одного канала с текущим счётчиком токенов.
+    Токены считаются один раз при добавлении реплики, поэтому сборка контекста
+    не перетокенизирует весь список на каждое сообщение.
+    Реплики хранятся компактно: кортеж (ответ бота?, текст, токены) вместо словаря.
+    """
+
+    __slots__ = (
+        "token_limit", "turns", "total_tokens", "size_bytes",
+        "_summary_lines", "_summary_tokens", "_summary_cache"
+    )
+
+    def __init__(self, token_limit: int):
+        self.token_limit = token_limit
+        self.turns = deque()  # (is_bot, content, tokens)
+        self.total_tokens = 0
+        self.size_bytes = sys.getsizeof(self.turns)
+        self._summary_lines = deque()  # (line, tokens)
+        self._summary_tokens = 0
+        self._summary_cache = None
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, role: str, content: str):
+        tokens = estimate_tokens(content)
+        self.turns.append((role == "assistant", content, tokens))
+        self.total_tokens += tokens
+        self.size_bytes += self._turn_size(content)
+        # Всё, что не влезет ни в один запрос, убираем (или сворачиваем в сводку)
+        while self.turns and (
+            len(self.turns) > MAX_HISTORY_LENGTH * 2 or self.total_tokens > self.token_limit
+        ):
+            self._fold(self._drop(self.turns.popleft()))
+
+    def pop(self):
+        is_bot, content, _ = self._drop(self.turns.pop())
+        return {"role": "assistant" if is_bot else "user", "content": content}
+
+    @staticmethod
+    def _turn_size(content: str) -> int:
+        # Кортеж из трёх элементов + строка + слот в deque
+        return 72 + sys.getsizeof(content) + 8
+
+    def _drop(self, turn):
+        self.total_tokens -= turn[2]
+        self.size_bytes -= self._turn_size(turn[1])
+        return turn
+
+    def _fold(self, turn):
+        is_bot, content, _ = turn
+        if not HISTORY_SUMMARY:
+            return
+        # Экстрактивная сводка: первое предложение реплики
+        first = re.split(r'(?<=[.!?])\s+', content.strip(), maxsplit=1)[0][:200]
+        if not first:
+            return
+        line = f"{'Ассистент' if is_bot else 'Пользователь'}: {first}"
+        line_tokens = estimate_tokens(line)
+        self._summary_lines.append((line, line_tokens))
+        self._summary_tokens += line_tokens
+        self.size_bytes += self._turn_size(line)
+        while self._summary_tokens > SUMMARY_TOKEN_BUDGET and self._summary_lines:
+            old_line, old_tokens = self._summary_lines.popleft()
+            self._summary_tokens -= old_tokens
+            self.size_bytes -= self._turn_size(old_line)
+        self._summary_cache = None
+
+    @property
+    def summary(self) -> str:
+        if self._summary_cache is None:
+            self._summary_cache = "\n".join(line for line, _ in self._summary_lines)
+        return self._summary_cache
+
+    @property
+    def summary_tokens(self) -> int:
+        return self._summary_tokens
+
+    def window(self, budget: int) -> list:
+        """Самые свежие реплики, суммарно укладывающиеся в budget токенов."""
+        selected = []
+        used = 0
+        for is_bot, content, tokens in reversed(self.turns):
+            if used + tokens > budget:
+                break
+            selected.append({"role": "assistant" if is_bot else "user", "content": content})
+            used += tokens
+        selected.reverse()
+        return selected
+
+class HistoryStore:
+    """
+    Истории всех каналов с общим лимитом памяти.
+    При превышении лимита вытесняются дольше всех не использовавшиеся каналы (LRU).
+    Вытесненные каналы и каналы после перезапуска лениво подгружаются из таблицы messages.
+    """
+
+    def __init__(self, token_limit: int, memory_limit: int = HISTORY_MEMORY_LIMIT,
+                 rehydrate_limit: int = HISTORY_REHYDRATE_LIMIT):
+        self.token_limit = token_limit
+        self.memory_limit = memory_limit
+        self.rehydrate_limit = rehydrate_limit
+        self.total_bytes = 0
+        self.evictions = 0
+        self._channels = OrderedDict()
+        self._loading = {}
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._channels
+
+    def __len__(self):
+        return len(self._channels)
+
+    def get(self, channel_id: int):
+        history = self._channels.get(channel_id)
+        if history is not None:
+            self._channels.move_to_end(channel_id)
+        return history
+
+    def _ensure(self, channel_id: int) -> ChannelHistory:
+        history = self.get(channel_id)
+        if history is None:
+            history = ChannelHistory(self.token_limit)
+            self._channels[channel_id] = history
+            self.total_bytes += history.size_bytes
+        return history
+
+    def append(self, channel_id: int, role: str, content: str):
+        history = self._ensure(channel_id)
+        before = history.size_bytes
+        history.append(role, content)
+        self.total_bytes += history.size_bytes - before
+        self._evict(keep=channel_id)
+
+    def pop(self, channel_id: int):
+        """Удаляет последнюю реплику канала (если она есть)."""
+        history = self._channels.get(channel_id)
+        if not history:
+            return None
+        before = history.size_bytes
+        turn = history.pop()
+        self.total_bytes += history.size_bytes - before
+        return turn
+
+    def largest(self, count: int) -> list:
+        """Каналы с самыми большими историями: список (channel_id, байты)."""
+        return heapq.nlargest(
+            count,
+            ((channel_id, history.size_bytes) for channel_id, history in self._channels.items()),
+            key=lambda item: item[1]
+        )
+
+    def _evict(self, keep: int):
+        while self.total_bytes > self.memory_limit and len(self._channels) > 1:
+            channel_id, history = next(iter(self._channels.items()))
+            if channel_id == keep:
+                self._channels.move_to_end(channel_id)
+                continue
+            del self._channels[channel_id]
+            self.total_bytes -= history.size_bytes
+            self.evictions += 1
+
+    async def load(self, channel_id: int, client: Client, allow=None):
+        """
+        Подгружает последние реплики канала из Supabase, если канала нет в памяти.
+        Одновременные упоминания в одном холодном канале ждут одной загрузки.
+        allow(text) — необязательная проверка реплик пользователей (фильтр контента).
+        """
+        if channel_id in self._channels or client is None:
+            return
+        task = self._loading.get(channel_id)
+        if task is None:
+            task = asyncio.create_task(self._rehydrate(channel_id, client, allow))
+            self._loading[channel_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(channel_id, None))
+        await task
+
+    def _fetch_recent(self, channel_id: int, client: Client) -> list:
+        result = (
+            client.table('messages')
+            .select('content,is_bot')
+            .eq('thread_id', str(channel_id))
+            .order('created_at', desc=True)
+            .limit(self.rehydrate_limit)
+            .execute()
+        )
+        return list(reversed(result.data or []))
+
+    @staticmethod
+    def _answered(rows: list, allow=None) -> list:
+        """
+        Оставляет реплики пользователей, за которыми следует ответ бота, как в памяти:
+        заблокированные и оставшиеся без ответа упоминания в Supabase есть, а в контексте нет.
+        """
+        answered, waiting = [], []
+        for row in rows:
+            if not row.get("content"):
+                continue
+            if row.get("is_bot"):
+                answered += waiting
+                answered.append(row)
+                waiting = []
+            elif allow is None or allow(row["content"]):
+                waiting.append(row)
+        return answered
+
+    async def _rehydrate(self, channel_id: int, client: Client, allow=None):
+        try:
+            rows = await asyncio.to_thread(self._fetch_recent, channel_id, client)
+        except Exception as e:
+            print(f"Ошибка загрузки истории канала {channel_id} из Supabase: {str(e)}")
+            return
+        if channel_id in self._channels:
+            return
+        history = self._ensure(channel_id)
+        before = history.size_bytes
+        for row in self._answered(rows, allow):
+            history.append("assistant" if row.get("is_bot") else "user", row["content"])
+        self.total_bytes += history.size_bytes - before
+        self._evict(keep=channel_id)
+        print(f"История канала {channel_id} загружена из Supabase: {len(history)} сообщений")
+
+class ResponseCache:
+    """
+    Кэш ответов модели с TTL и вытеснением по LRU.
+    Ключ — хэш модели, системного промпта и нормализованного контекста.
+    Хранится «сырой» ответ: проверка и форматирование выполняются и при попадании в кэш.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_size: int = RESPONSE_CACHE_SIZE,
+                 fuzzy: bool = RESPONSE_CACHE_FUZZY):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.fuzzy = fuzzy
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _normalize(self, text: str) -> str:
+        text = normalize_text(text)
+        if self.fuzzy:
+            # Порядок слов не важен, но все слова сохраняются; отрицание «не»/«ни»
+            # склеивается со следующим словом, чтобы не потерять его при сортировке
+            text = re.sub(r'\b(не|ни)\s+', r'\1_', text)
+            text = " ".join(sorted(text.split()))
+        return text
+
+    def make_key(self, model: str, system_prompt: str, context: list) -> str:
+        """context — список пар (role, text) в хронологическом порядке."""
+        normalized = [[role, self._normalize(text)] for role, text in context]
+        raw = json.dumps([model, system_prompt, normalized], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, text: str):
+        self._entries[key] = (time.monotonic() + self.ttl, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+class PreparedImage(NamedTuple):
+    """Картинка, готовая к отправке в модель: имя файла, хэш содержимого и URL (data: или CDN)."""
+    filename: str
+    digest: str
+    url: str
+
+class VisionPipeline:
+    """
+    Подготовка картинок из вложений: параллельная загрузка, уменьшение до VISION_MAX_SIDE
+    и перекодирование в VISION_FORMAT. Результаты кэшируются по ID вложения (повторный вопрос
+    к той же картинке не качает её заново) и по хэшу содержимого (та же картинка, загруженная
+    снова, не перекодируется). Размер кэша ограничен VISION_CACHE_LIMIT байт,
+    число запомненных вложений — VISION_ATTACHMENT_CACHE_SIZE (оба вытесняются по LRU).
+    """
+
+    def __init__(self, max_images: int = VISION_MAX_IMAGES, cache_limit: int = VISION_CACHE_LIMIT,
+                 attachment_limit: int = VISION_ATTACHMENT_CACHE_SIZE):
+        self.max_images = max_images
+        self.cache_limit = cache_limit
+        self.attachment_limit = attachment_limit
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._by_digest = OrderedDict()  # хэш -> data URL
+        self._by_attachment = OrderedDict()  # ID вложения -> хэш
+
+    def select(self, attachments) -> list:
+        return [att for att in attachments if is_image_attachment(att)][:self.max_images]
+
+    async def prepare(self, attachments) -> list:
+        """Готовит до max_images картинок из вложений (параллельно)."""
+        return list(await asyncio.gather(*(self._prepare_one(att) for att in self.select(attachments))))
+
+    @staticmethod
+    def _fallback(attachment) -> PreparedImage:
+        # Без обработки: модель сама скачает исходный файл по ссылке
+        url = attachment.url
+        digest = hashlib.sha256(url.split("?")[0].encode("utf-8")).hexdigest()
+        return PreparedImage(attachment.filename, digest, url)
+
+    def _cached(self, digest: str):
+        data_url = self._by_digest.get(digest)
+        if data_url is not None:
+            self._by_digest.move_to_end(digest)
+        return data_url
+
+    def _store(self, digest: str, data_url: str):
+        if digest in self._by_digest:
+            return
+        self._by_digest[digest] = data_url
+        self.cache_bytes += len(data_url)
+        while self.cache_bytes > self.cache_limit and len(self._by_digest) > 1:
+            old_digest, old_url = self._by_digest.popitem(last=False)
+            self.cache_bytes -= len(old_url)
+
+    async def _prepare_one(self, attachment) -> PreparedImage:
+        digest = self._by_attachment.get(attachment.id)
+        if digest is not None:
+            self._by_attachment.move_to_end(attachment.id)
+            data_url = self._cached(digest)
+            if data_url is not None:
+                self.hits += 1
+                return PreparedImage(attachment.filename, digest, data_url)
+
+        if Image is None or attachment.size > VISION_MAX_DOWNLOAD:
+            return self._fallback(attachment)
+
+        try:
+            data = await attachment.read()
+        except discord.HTTPException as e:
+            print(f"Не удалось скачать вложение {attachment.filename}: {e}")
+            return self._fallback(attachment)
+
+        digest = hashlib.sha256(data).hexdigest()
+        self._by_attachment[attachment.id] = digest
+        if len(self._by_attachment) > self.attachment_limit:
+            self._by_attachment.popitem(last=False)
+        data_url = self._cached(digest)
+        if data_url is not None:
+            self.hits += 1
+            return PreparedImage(attachment.filename, digest, data_url)
+
+        self.misses += 1
+        try:
+            data_url = await asyncio.to_thread(self._encode, data)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"Не удалось обработать картинку {attachment.filename}: {e}")
+            return self._fallback(attachment)
+        self._store(digest, data_url)
+        return PreparedImage(attachment.filename, digest, data_url)
+
+    @staticmethod
+    def _encode(data: bytes) -> str:
+        """Уменьшает картинку и перекодирует в data URL (выполняется в отдельном потоке)."""
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+            if VISION_FORMAT == "JPEG" and image.mode != "RGB":
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, format=VISION_FORMAT, quality=VISION_QUALITY)
+        encoded = base64.b64encode(output.getvalue()).decode("ascii")
+        return f"data:image/{VISION_FORMAT.lower()};base64,{encoded}"
+
+class ChannelScheduler:
+    """
+    Очередь упоминаний по каналам. Реплики одного канала обрабатываются строго по порядку.
+    Если задан COALESCE_WINDOW, упоминания, накопившиеся за время обработки предыдущей
+    реплики или пришедшие в течение окна, объединяются в один запрос к модели;
+    иначе каждое упоминание получает свой ответ.
+    Глубина очереди ограничена на канал и на сервер, чтобы шумный канал не занимал всех.
+    """
+
+    def __init__(self, handler, channel_limit: int = CHANNEL_QUEUE_LIMIT,
+                 guild_limit: int = GUILD_QUEUE_LIMIT, window: float = COALESCE_WINDOW,
+                 max_batch: int = COALESCE_MAX_MESSAGES):
+        self.handler = handler
+        self.channel_limit = channel_limit
+        self.guild_limit = guild_limit
+        self.window = window
+        self.max_batch = max_batch
+        self._queues = {}
+        self._workers = {}
+        self._guild_pending = {}
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def active(self) -> int:
+        return len(self._workers)
+
+    @staticmethod
+    def _guild_id(message: Message):
+        return message.guild.id if message.guild else None
+
+    @staticmethod
+    def _has_image(message: Message) -> bool:
+        return any(is_image_attachment(att) for att in message.attachments)
+
+    def submit(self, message: Message) -> bool:
+        """Ставит упоминание в очередь канала. Возвращает False, если очередь переполнена."""
+        channel_id = message.channel.id
+        guild_id = self._guild_id(message)
+        if guild_id is not None and self._guild_pending.get(guild_id, 0) >= self.guild_limit:
+            return False
+        queue = self._queues.setdefault(channel_id, deque())
+        if len(queue) >= self.channel_limit:
+            return False
+
+        queue.append((message, time.perf_counter()))
+        if guild_id is not None:
+            self._guild_pending[guild_id] = self._guild_pending.get(guild_id, 0) + 1
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._run(channel_id))
+        return True
+
+    def _take(self, queue: deque):
+        """
+        Забирает из очереди следующую пачку (упоминания с картинками идут по одному).
+        Возвращает сообщения и время постановки в очередь первого из них.
+        """
+        first, enqueued_at = queue.popleft()
+        batch = [first]
+        if self.window > 0 and not self._has_image(first):
+            while queue and len(batch) < self.max_batch and not self._has_image(queue[0][0]):
+                batch.append(queue.popleft()[0])
+        for message in batch:
+            guild_id = self._guild_id(message)
+            if guild_id is not None:
+                self._guild_pending[guild_id] -= 1
+                if not self._guild_pending[guild_id]:
+                    del self._guild_pending[guild_id]
+        return batch, enqueued_at
+
+    async def _run(self, channel_id: int):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                if self.window > 0 and len(queue) < self.max_batch:
+                    await asyncio.sleep(self.window)
+                batch, enqueued_at = self._take(queue)
+                try:
+                    await self.handler(batch, enqueued_at)
+                except Exception as e:
+                    print(f"Ошибка обработки сообщения в канале {channel_id}: {e!r}")
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+
+class TokenBucket:
+    """Ведро токенов: capacity — допустимый всплеск, rate — пополнение в секунду."""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated", "warned")
+
+    def __init__(self, capacity: int, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = now
+        # Уже сообщили ли пользователю об отказе с момента последнего успешного запроса
+        self.warned = False
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+class RateLimit(NamedTuple):
+    scope: str
+    notify: bool
+
+class RateLimiter:
+    """
+    Ограничитель частоты упоминаний по пользователю, каналу и серверу.
+    Запрос проходит, только если токен есть во всех вёдрах сразу, — отказ
+    на одном уровне не тратит токены других.
+    """
+
+    def __init__(self, limits: dict, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        # limits: уровень -> (burst, пополнение в минуту); уровни с нулевым burst пропускаются
+        self.limits = {
+            scope: (burst, per_minute / 60)
+            for scope, (burst, per_minute) in limits.items() if burst > 0
+        }
+        self.max_keys = max_keys
+        self.buckets = {scope: OrderedDict() for scope in self.limits}
+        self.rejected = {scope: 0 for scope in self.limits}
+
+    def _bucket(self, scope: str, key, now: float) -> TokenBucket:
+        buckets = self.buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            burst, rate = self.limits[scope]
+            bucket = buckets[key] = TokenBucket(burst, rate, now)
+            if len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, keys: dict) -> RateLimit:
+        """
+        keys: уровень -> ключ (None — уровень не применяется, например сервер в ЛС).
+        Возвращает None, если запрос разрешён, иначе RateLimit с уровнем отказа;
+        notify истинно только для первого отказа подряд, чтобы не отвечать на каждый спам.
+        """
+        now = time.monotonic()
+        buckets = [
+            (scope, self._bucket(scope, key, now))
+            for scope, key in keys.items() if key is not None and scope in self.limits
+        ]
+        for scope, bucket in buckets:
+            if bucket.refill(now) < 1:
+                self.rejected[scope] += 1
+                notify = not bucket.warned
+                bucket.warned = True
+                return RateLimit(scope, notify)
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+            bucket.warned = False
+        return None
+
+class UsageTracker:
+    """Учёт токенов OpenRouter: общие счётчики и квота на пользователя за окно."""
+
+    def __init__(self, quota: int = USER_TOKEN_QUOTA, window: float = USER_QUOTA_WINDOW,
+                 max_users: int = RATE_LIMIT_MAX_KEYS):
+        self.quota = quota
+        self.window = window
+        self.max_users = max_users
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.rejected = 0
+        # user_id -> [начало окна, израсходовано токенов, сообщено ли об отказе];
+        # порядок — от давно неактивных к недавним, как вёдра в RateLimiter
+        self._users = OrderedDict()
+
+    @staticmethod
+    def parse(usage) -> tuple:
+        """(prompt_tokens, completion_tokens) из поля usage ответа OpenRouter или None."""
+        if not isinstance(usage, dict):
+            return None
+        try:
+            return int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+        except (TypeError, ValueError):
+            return None
+
+    def _window(self, user_id: int, now: float) -> list:
+        entry = self._users.get(user_id)
+        if entry is None or now - entry[0] >= self.window:
+            entry = self._users[user_id] = [now, 0, False]
+        self._users.move_to_end(user_id)
+        # Вытесняем давно неактивных: с истёкшим окном или сверх max_users
+        while self._users:
+            oldest = next(iter(self._users.values()))
+            if len(self._users) <= self.max_users and now - oldest[0] < self.window:
+                break
+            self._users.popitem(last=False)
+        return entry
+
+    def record(self, user_id: int, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        if self.quota > 0:
+            self._window(user_id, time.monotonic())[1] += prompt_tokens + completion_tokens
+
+    def check(self, user_id: int) -> RateLimit:
+        """None, если квота пользователя не исчерпана, иначе RateLimit("quota", ...)."""
+        if self.quota <= 0 or user_id not in self._users:
+            return None
+        entry = self._window(user_id, time.monotonic())
+        if entry[1] < self.quota:
+            return None
+        self.rejected += 1
+        notify = not entry[2]
+        entry[2] = True
+        return RateLimit("quota", notify)
+
 class SafetyBot(commands.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.conversation_history = {}
+        # Храним не больше, чем поместится в запрос рядом с промптом, сводкой и ответом
+        token_limit = (
+            context_budget_for(MODEL)
+            - MAX_COMPLETION_TOKENS
+            - estimate_tokens(SAFETY_PROMPT)
+            - (SUMMARY_TOKEN_BUDGET if HISTORY_SUMMARY else 0)
+        )
+        self.conversation_history = HistoryStore(max(token_limit, 0))
+        self.api = OpenRouterClient(ENDPOINT, OPENROUTER_API_KEY)
+        self.writer = SupabaseWriter(supabase) if supabase else None
+        self.usage_writer = SupabaseWriter(supabase, table=USAGE_TABLE) if supabase else None
+        self.scheduler = ChannelScheduler(lambda messages, enqueued_at: handle_turn(messages, enqueued_at))
+        self.cache = ResponseCache() if RESPONSE_CACHE else None
+        self.content_filter = ContentFilter.load(CONTENT_RULES_FILE)
+        self.vision = VisionPipeline()
+        self.rate_limiter = RateLimiter({
+            "user": (RATE_LIMIT_USER_BURST, RATE_LIMIT_USER_PER_MINUTE),
+            "channel": (RATE_LIMIT_CHANNEL_BURST, RATE_LIMIT_CHANNEL_PER_MINUTE),
+            "guild": (RATE_LIMIT_GUILD_BURST, RATE_LIMIT_GUILD_PER_MINUTE),
+        })
+        self.usage = UsageTracker()
+
+    async def setup_hook(self):
+        # Пул соединений и фоновая запись создаются в цикле событий бота
+        await self.api.start()
+        if self.writer:
+            self.writer.start()
+        if self.usage_writer:
+            self.usage_writer.start()
+        self._rules_task = asyncio.create_task(self.watch_content_rules())
+        self._monitor_task = asyncio.create_task(self.monitor())
+
+    async def close(self):
+        if self.writer:
+            await self.writer.close()
+        if self.usage_writer:
+            await self.usage_writer.close()
+        await self.api.close()
+        await super().close()
     
-    def deep_content_check(self, text: str) -> bool:
+    async def monitor(self):
+        """Замеряет задержку цикла событий и обновляет метрики состояния."""
+        loop = asyncio.get_running_loop()
+        while not self.is_closed():
+            started = loop.time()
+            await asyncio.sleep(METRICS_INTERVAL)
+            metrics.set("aibot_event_loop_lag_seconds", max(0.0, loop.time() - started - METRICS_INTERVAL))
+            self.update_metrics()
+            self.report_shards()
+            if WORKER_NAME is not None:
+                WORKER_METRICS[WORKER_NAME] = metrics.snapshot()
+
+    def report_shards(self):
+        """Публикует готовность и задержку шардов этого процесса в SHARD_STATUS."""
+        if isinstance(self, commands.AutoShardedBot):
+            latencies = dict(self.latencies)
+            shard_ids = list(self.shards) or self.shard_ids or []
+        else:
+            latencies = {self.shard_id or 0: self.latency}
+            shard_ids = [self.shard_id or 0]
+
+        guilds = {}
+        for guild in self.guilds:
+            guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+        now = time.time()
+        for shard_id in shard_ids:
+            latency = latencies.get(shard_id, float("nan"))
+            connected = math.isfinite(latency)
+            SHARD_STATUS[shard_id] = {
+                "ready": self.is_ready() and connected,
+                "latency": latency if connected else -1.0,
+                "guilds": guilds.get(shard_id, 0),
+                "pid": os.getpid(),
+                "updated": now,
+            }
+
+    def update_metrics(self):
+        """Переносит текущее состояние очередей, истории и кэша в метрики."""
+        metrics.set("aibot_queue_pending", self.scheduler.pending)
+        metrics.set("aibot_queue_active_channels", self.scheduler.active)
+        metrics.set("aibot_upstream_in_flight", self.api.in_flight)
+        metrics.set("aibot_upstream_concurrency_limit", self.api.concurrency)
+        for model, breaker in self.api.breakers.items():
+            metrics.set("aibot_circuit_open", int(breaker.state == "open"), model=model)
+
+        if self.writer:
+            metrics.set("aibot_supabase_queue_depth", self.writer.queue.qsize())
+            metrics.set("aibot_supabase_rows_written", self.writer.written)
+            metrics.set("aibot_supabase_rows_dropped", self.writer.dropped)
+        if self.usage_writer:
+            metrics.set("aibot_usage_rows_dropped", self.usage_writer.dropped)
+        for scope, count in self.rate_limiter.rejected.items():
+            metrics.set("aibot_rate_limited_total", count, scope=scope)
+        if self.usage.quota > 0:
+            metrics.set("aibot_rate_limited_total", self.usage.rejected, scope="quota")
+
+        history = self.conversation_history
+        metrics.set("aibot_history_channels", len(history))
+        metrics.set("aibot_history_bytes", history.total_bytes)
+        metrics.set("aibot_history_evictions", history.evictions)
+        metrics.clear("aibot_history_channel_bytes")
+        for channel_id, size in history.largest(METRICS_TOP_CHANNELS):
+            metrics.set("aibot_history_channel_bytes", size, channel=channel_id)
+
+        if self.cache is not None:
+            metrics.set("aibot_cache_hits", self.cache.hits)
+            metrics.set("aibot_cache_misses", self.cache.misses)
+            metrics.set("aibot_cache_entries", len(self.cache))
+
+    def deep_content_check(self, text: str, incoming: bool = False, mentions: int = 0,
+                           command_text: str = None) -> bool:
         """
-        Проверка контента на запрещённые ключевые слова.
-        Возвращает True, если нужно заблокировать ответ.
+        Проверка контента по правилам фильтра.
+        Возвращает True, если нужно заблокировать сообщение или ответ.
         """
-        # Пример проверки: если есть совпадение по CONTENT_FILTERS, блокируем
-        if CONTENT_FILTERS.search(text):
+        match = self.content_filter.check(text, incoming, mentions, command_text)
+        if match:
+            print(f"Сработало правило фильтра «{match.rule}»: {match.term}")
             return True
         return False
 
-    async def format_response(self, text: str) -> str:
+    async def watch_content_rules(self):
+        """Перечитывает файл правил при изменении (сборка автомата — в отдельном потоке)."""
+        while not self.is_closed():
+            await asyncio.sleep(CONTENT_RULES_RELOAD_INTERVAL)
+            if not self.content_filter.changed():
+                continue
+            try:
+                self.content_filter = await asyncio.to_thread(ContentFilter.load, CONTENT_RULES_FILE)
+                print(f"Правила фильтра перезагружены: {self.content_filter.size} терминов")
+            except Exception as e:
+                # Задача перезагрузки не должна умирать ни от какого файла правил
+                print(f"Ошибка загрузки правил фильтра: {e!r}")
+                # Не пытаемся повторно загружать тот же сломанный файл
+                try:
+                    self.content_filter.mtime = os.path.getmtime(CONTENT_RULES_FILE)
+                except OSError:
+                    self.content_filter.mtime = None
+
+    async def format_response(self, text: str) -> list:
         """
-        Триминг ответа по длине, если он слишком большой
+        Проверяет и чинит разметку ответа и делит его на сообщения Discord.
+        Возвращает не больше MAX_RESPONSE_MESSAGES частей.
         """
-        cleaned = re.sub(r'\*{1,2}|_{1,2}|`{1,3}', '', text)
-        sentences = re.split(r'(?<=[.!?])\s+', cleaned)
-        filtered = []
-        total_length = 0
-        for sentence in sentences:
-            if total_length + len(sentence) < MAX_RESPONSE_LENGTH - 3:
-                filtered.append(sentence)
-                total_length += len(sentence)
-            else:
-                break
-        result = ' '.join(filtered).strip()
-        if len(filtered) != len(sentences):
-            result += "..."
-        return result
+        formatter = ResponseFormatter()
+        parts = formatter.feed(text) + formatter.finish()
+        if len(parts) > MAX_RESPONSE_MESSAGES:
+            parts = parts[:MAX_RESPONSE_MESSAGES]
+            parts[-1] += "..."
+        return parts
 
     def update_history(self, thread_id: int, role: str, content: str):
         """Сохраняем историю переписки (только текстовые запросы/ответы)."""
-        if thread_id not in self.conversation_history:
-            self.conversation_history[thread_id] = []
-        self.conversation_history[thread_id].append({"role": role, "content": content})
+        self.conversation_history.append(thread_id, role, content)
+
+    def recent_turns(self, thread_id: int, count: int) -> list:
+        """Последние count реплик канала в виде пар (role, text)."""
+        history = self.conversation_history.get(thread_id)
+        if not history or count <= 0:
+            return []
+        recent = [
+            ("assistant" if is_bot else "user", content)
+            for is_bot, content, _ in itertools.islice(reversed(history.turns), count)
+        ]
+        recent.reverse()
+        return recent
+
+    async def load_history(self, thread_id: int):
+        """
+        Подгружает историю канала из Supabase, если её нет в памяти.
+        Заблокированные фильтром сообщения пользователей в контекст не возвращаются.
+        """
+        await self.conversation_history.load(
+            thread_id, supabase,
+            allow=lambda text: not self.content_filter.check(strip_think(text), incoming=True)
+        )
+
+    def build_context(self, thread_id: int, system_prompt: str, user_text: str = None,
+                      reserve_tokens: int = 0) -> list:
+        """
+        Собирает сообщения для запроса: системный промпт, сводка старых реплик,
+        самые свежие реплики, укладывающиеся в бюджет токенов модели, и новая реплика user_text.
+        reserve_tokens — дополнительный запас под то, что не входит в текст (например, картинки).
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+        current = [{"role": "user", "content": user_text}] if user_text is not None else []
+        history = self.conversation_history.get(thread_id)
+        if history is None:
+            return messages + current
 
-        # Если история слишком большая, обрезаем
-        if len(self.conversation_history[thread_id]) > MAX_HISTORY_LENGTH * 2:
-            self.conversation_history[thread_id] = self.conversation_history[thread_id][-MAX_HISTORY_LENGTH*2:]
+        budget = context_budget_for(MODEL) - MAX_COMPLETION_TOKENS - estimate_tokens(system_prompt) - reserve_tokens
+        if user_text is not None:
+            budget -= estimate_tokens(user_text)
+        if history.summary:
+            messages.append({
+                "role": "system",
+                "content": f"Краткое содержание более ранней переписки:\n{history.summary}"
+            })
+            budget -= history.summary_tokens
+        return messages + history.window(max(budget, 0)) + current
     
-    async def save_to_supabase(self, thread_id: int, author_id: int, content: str, is_bot: bool):
-        """Сохраняет сообщение в Supabase"""
-        if not supabase:
+    def save_to_supabase(self, thread_id: int, author_id: int, content: str, is_bot: bool) -> bool:
+        """Ставит сообщение в очередь на запись в Supabase (не блокирует)."""
+        if not self.writer:
             return False
-            
-        try:
-            message_data = {
-                "thread_id": str(thread_id),
-                "author_id": str(author_id),
-                "content": content,
-                "is_bot": is_bot,
+
+        message_data = {
+            "thread_id": str(thread_id),
+            "author_id": str(author_id),
+            "content": content,
+            "is_bot": is_bot,
+            "created_at": datetime.now().isoformat()
+        }
+        return self.writer.enqueue(message_data)
+
+    def record_usage(self, message: Message, model: str, usage: dict):
+        """
+        Учитывает токены ответа OpenRouter и ставит строку учёта в очередь на запись в Supabase.
+        Объединённая реплика записывается на автора сообщения, на которое отвечает бот.
+        """
+        tokens = UsageTracker.parse(usage)
+        if tokens is None:
+            return
+        prompt_tokens, completion_tokens = tokens
+        self.usage.record(message.author.id, prompt_tokens, completion_tokens)
+        metrics.inc("aibot_upstream_tokens_total", prompt_tokens, model=model, kind="prompt")
+        metrics.inc("aibot_upstream_tokens_total", completion_tokens, model=model, kind="completion")
+        if self.usage_writer:
+            self.usage_writer.enqueue({
+                "user_id": str(message.author.id),
+                "guild_id": str(message.guild.id) if message.guild else None,
+                "thread_id": str(message.channel.id),
+                "model": model,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
                 "created_at": datetime.now().isoformat()
-            }
-            
-            result = supabase.table('messages').insert(message_data).execute()
-            if hasattr(result, 'data') and result.data:
-                return True
-            return False
-        except Exception as e:
-            print(f"Ошибка при сохранении в Supabase: {str(e)}")
-            return False
+            })
+
+class ShardedSafetyBot(SafetyBot, commands.AutoShardedBot):
+    """SafetyBot поверх AutoShardedBot: несколько шардов в одном процессе и цикле событий."""
+
+def build_intents() -> discord.Intents:
+    if not MINIMAL_INTENTS:
+        return discord.Intents.all()
+    # Для ответов на упоминания нужны только серверы, сообщения и их текст
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    return intents
+
+def parse_shard_ids(text: str) -> list:
+    """Разбирает список шардов вида «0-3,6»."""
+    shard_ids = []
+    for part in filter(None, (piece.strip() for piece in text.split(","))):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            shard_ids.extend(range(int(first), int(last) + 1))
+        else:
+            shard_ids.append(int(part))
+    return shard_ids
+
+def create_bot(shard_ids: list = None, shard_count: int = None, sharded: bool = False) -> SafetyBot:
+    """
+    Создаёт бота и подключает обработчики событий. Бот шардированный, если задан
+    sharded или шарды; без шардов и их числа AutoShardedBot сам узнаёт число шардов у Discord.
+    """
+    if not sharded and shard_ids is None and shard_count is None:
+        new_bot = SafetyBot(command_prefix="!", intents=build_intents())
+    else:
+        new_bot = ShardedSafetyBot(
+            command_prefix="!",
+            intents=build_intents(),
+            shard_ids=shard_ids,
+            shard_count=shard_count
+        )
+    new_bot.event(on_ready)
+    new_bot.event(on_message)
+    return new_bot
 
-bot = SafetyBot(command_prefix="!", intents=discord.Intents.all())
+bot = SafetyBot(command_prefix="!", intents=build_intents())
 
 @bot.event
 async def on_ready():
@@ -177,192 +2462,457 @@ async def on_message(message: Message):
     
     print(f"Бот упомянут в сообщении от {message.author.name} в канале {message.channel.id}")
 
+    # Лимиты проверяем до очереди, истории и запроса к модели; отказ — только реакцией
+    limit = bot.rate_limiter.allow({
+        "user": message.author.id,
+        "channel": message.channel.id,
+        "guild": message.guild.id if message.guild else None,
+    })
+    if limit is None:
+        limit = bot.usage.check(message.author.id)
+    if limit is not None:
+        print(f"Упоминание от {message.author.name} отклонено: лимит уровня {limit.scope}")
+        if limit.notify:
+            try:
+                await message.add_reaction('🚫' if limit.scope == "quota" else '🐢')
+            except discord.HTTPException:
+                print("Нет разрешения добавить реакцию.")
+        return
+
+    # Ставим упоминание в очередь канала; при переполнении отвечаем дешёвой реакцией
+    if not bot.scheduler.submit(message):
+        print(f"Очередь канала {message.channel.id} переполнена, упоминание отклонено")
+        try:
+            await message.add_reaction('⏳')
+        except discord.HTTPException:
+            print("Нет разрешения добавить реакцию.")
+
+def build_payload(messages: list) -> dict:
+    """Базовый набор параметров запроса к модели."""
+    payload = {
+        "model": MODEL,
+        "messages": messages,
+        "temperature": 0.3,
+        "max_tokens": MAX_COMPLETION_TOKENS
+    }
+
+    # Добавляем специфичные параметры в зависимости от модели
+    if "gemini" not in MODEL.lower():
+        # Эти параметры не поддерживаются Gemini-моделями
+        payload["frequency_penalty"] = 1.2
+        payload["presence_penalty"] = 0.9
+    return payload
+
+async def handle_turn(messages: list, enqueued_at: float = None):
+    """
+    Обрабатывает одну реплику канала: одно упоминание или пачку объединённых упоминаний.
+    Вызывается планировщиком канала, поэтому реплики одного канала идут строго по очереди.
+    """
+    span = MentionSpan(messages[-1].channel.id, len(messages))
+    if enqueued_at is not None:
+        span.record("queue_wait", time.perf_counter() - enqueued_at)
+    token = CURRENT_SPAN.set(span)
+    outcome = "error"
+    try:
+        outcome = await process_turn(messages, span)
+    finally:
+        CURRENT_SPAN.reset(token)
+        span.finish(outcome)
+
+async def process_turn(messages: list, span: MentionSpan) -> str:
+    """Тело обработки реплики. Возвращает итог для метрик."""
+    message = messages[-1]
+    channel_id = message.channel.id
+
     # Показываем индикатор "печатает", чтобы пользователь видел, что бот обрабатывает запрос
     async with message.channel.typing():
-        # Сохраняем сообщение пользователя в Supabase
+        # Подгружаем историю канала, если её нет в памяти (до записи новых сообщений)
+        with span.phase("history_build"):
+            await bot.load_history(channel_id)
+
+        # Ставим сообщения пользователей в очередь на запись в Supabase: в журнал попадает
+        # каждое упоминание, а в контекст при подгрузке — только те, на которые бот ответил
         if supabase:
-            await bot.save_to_supabase(
-                message.channel.id, 
-                message.author.id, 
-                message.clean_content, 
-                False
-            )
+            with span.phase("supabase_save"):
+                for pending in messages:
+                    bot.save_to_supabase(
+                        channel_id,
+                        pending.author.id,
+                        pending.clean_content,
+                        False
+                    )
 
-        # Проверяем, есть ли вложения-изображения
+        # Проверяем, есть ли вложения-изображения (такие упоминания не объединяются)
         has_image = any(is_image_attachment(att) for att in message.attachments)
 
-    # Удаляем блоки <think>...</think> из пользовательского текста
-    user_text = strip_think(message.clean_content)
-    print(f"Обработанный текст пользователя: {user_text}")
+    allowed = []
+    for pending in messages:
+        # Удаляем блоки <think>...</think> из пользовательского текста
+        text = strip_think(pending.clean_content)
+        print(f"Обработанный текст пользователя: {text}")
 
-    # Проверка «запрещённого» текста (пример)
-    if bot.deep_content_check(user_text):
-        try:
-            return await message.reply("Обсуждение данной темы запрещено правилами.")
-        except discord.Forbidden:
-            print("Нет прав отвечать в этот канал.")
-        return
+        # Проверка «запрещённого» текста
+        with span.phase("content_check"):
+            blocked = bot.deep_content_check(
+                text, incoming=True, mentions=len(pending.mentions),
+                command_text=strip_leading_mentions(pending)
+            )
+        if blocked:
+            try:
+                await pending.reply("Обсуждение данной темы запрещено правилами.")
+            except discord.Forbidden:
+                print("Нет прав отвечать в этот канал.")
+            continue
+        allowed.append((pending, text))
 
-    # Если есть изображение, готовим запрос как vision
-    if has_image:
-        vision_instructions = (
-"""Ты профессиональный ассистент. Строгие правила:
-1. Запрещено обсуждать:
-   - Суицид, депрессию и методы самоповреждения
-   - Любые сериалы/фильмы о запрещенной тематике
-   - Расизм, нацистская символика, нацизм, фашизм.
-   - Обсуждения/упоминания/разговоры политического характера.
-   - Контент 18+ [ ники, аватарки, картинки ].
-   - Притеснения по политическим, религиозным/ориентационным и личным взглядам.
-   - Спам/Флуд/Оффтоп картинками, эмодзи, реакциями, символами и прочими вещами где-либо - запрещено.
-   - Запрещено спамить пингами любых участников сервера.
-   - Умышленное рекламирование своего или чужого ютуб-канала и прочего контента без разрешения @Volidorka или @Миса [ВПП] - запрещено
-   - Нельзя писать команды с префиксом * например: *crime, и так далее и еще # например #ранг и еще + например +1
-   - Все математические формулы и расчёты выводи в простом текстовом формате (например: P = F / A, без LaTeX или Markdown).
-2. При нарушении правил пользователем:
-   - Вежливо отказывайся продолжать разговор
-   - Не упоминай конкретные названия или имена
-   - Предлагай обратиться к специалистам"""
-        )
-        combined_text = vision_instructions + (f"\nПользовательский запрос: {user_text}" if user_text else "")
-        
-        # Формируем «multimodal» контент (зависит от того, поддерживает ли модель формат type:image_url)
-        vision_content = [{"type": "text", "text": combined_text}]
-        for att in message.attachments:
-            if is_image_attachment(att):
-                vision_content.append({"type": "image_url", "image_url": {"url": att.url}})
-                break
+    if not allowed:
+        return "blocked"
 
-        # Базовый набор параметров
-        payload = {
-            "model": MODEL,
-            "messages": [{"role": "user", "content": vision_content}],
-            "temperature": 0.3,
-            "max_tokens": 600
-        }
-        
-        # Добавляем специфичные параметры в зависимости от модели
-        if "gemini" not in MODEL.lower():
-            # Эти параметры не поддерживаются Gemini-моделями
-            payload["frequency_penalty"] = 1.2
-            payload["presence_penalty"] = 0.9
-            
-        endpoint = ENDPOINT
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json"
-        }
+    # Отвечаем на последнее сообщение; при объединении подписываем реплики авторами
+    message = allowed[-1][0]
+    if len(allowed) == 1:
+        user_text = allowed[0][1]
     else:
-        # Иначе это чисто текстовый запрос
-        # Сохраняем в историю
-        bot.update_history(message.channel.id, "user", user_text)
-        
-        # Базовый набор параметров
-        payload = {
-            "model": MODEL,
-            "messages": (
-                [{"role": "system", "content": SAFETY_PROMPT}]
-                + bot.conversation_history[message.channel.id]
-            ),
-            "temperature": 0.3,
-            "max_tokens": 600
-        }
-        
-        # Добавляем специфичные параметры в зависимости от модели
-        if "gemini" not in MODEL.lower():
-            # Эти параметры не поддерживаются Gemini-моделями
-            payload["frequency_penalty"] = 1.2
-            payload["presence_penalty"] = 0.9
-            
-        endpoint = ENDPOINT
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        user_text = "\n".join(f"{pending.author.display_name}: {text}" for pending, text in allowed)
 
-    # Определяем функцию для API запроса
-    def make_api_request():
-        try:
-            return requests.post(endpoint, headers=headers, json=payload, timeout=30)
-        except Exception as e:
-            print(f"Ошибка API запроса: {e}")
-            return None
-    
-    # Выполняем запрос в отдельном потоке
-    loop = asyncio.get_event_loop()
-    response = await loop.run_in_executor(executor, make_api_request)
-    
-    if response and response.status_code == 200:
-        data = response.json()
-        if "choices" in data:
-            raw_response = data['choices'][0]['message']['content']
-            raw_response = strip_think(raw_response)
-
-            # Проверяем контент ответа (при желании)
-            if bot.deep_content_check(raw_response):
-                try:
-                    await message.reply("Не могу ответить на этот вопрос (контент запрещён).")
-                except discord.Forbidden:
-                    print("Нет разрешения отправить ответ.")
-                # Если текстовый запрос, удаляем последний «user»
-                if not has_image and bot.conversation_history[message.channel.id]:
-                    bot.conversation_history[message.channel.id].pop()
-                return
+    # Если есть изображения, готовим запрос как vision: история канала + текст и картинки
+    if has_image:
+        with span.phase("image_prepare"):
+            images = await bot.vision.prepare(message.attachments)
+        names = ", ".join(image.filename for image in images)
+        # В историю попадает только текст с пометкой о картинках, сами картинки не пересылаются
+        history_text = f"{user_text}\n[Изображения: {names}]" if user_text else f"[Изображения: {names}]"
 
-            # Форматируем ответ
-            final_response = await bot.format_response(raw_response)
-            if final_response.strip():
-                await message.reply(final_response)
-                
-                # Сохраняем ответ бота в Supabase
-                await bot.save_to_supabase(
-                    message.channel.id,
-                    bot.user.id,
-                    final_response,
-                    True
-                )
-                
-            else:
-                print(f"Не удалось получить непустой ответ после {MAX_RETRIES} попыток.")
-                try:
-                    await message.add_reaction('⚠')
-                    await message.reply("Я получил пустой ответ от API. Пожалуйста, попробуйте переформулировать вопрос.")
-                except discord.Forbidden:
-                    print("Нет разрешения отправить ответ или добавить реакцию.")
-                if not has_image and bot.conversation_history[message.channel.id]:
-                    bot.conversation_history[message.channel.id].pop()
-                return
+        with span.phase("history_build"):
+            context = bot.build_context(
+                channel_id, VISION_PROMPT, history_text,
+                reserve_tokens=VISION_IMAGE_TOKENS * len(images)
+            )
+        # Формируем «multimodal» контент (зависит от того, поддерживает ли модель формат type:image_url)
+        vision_content = [{"type": "text", "text": user_text or "Опиши изображение."}]
+        vision_content += [{"type": "image_url", "image_url": {"url": image.url}} for image in images]
+        context[-1] = {"role": "user", "content": vision_content}
+        payload = build_payload(context)
+    else:
+        # Иначе это чисто текстовый запрос: история + новая реплика пользователя
+        history_text = user_text
+        with span.phase("history_build"):
+            payload = build_payload(bot.build_context(channel_id, SAFETY_PROMPT, user_text))
 
-            # Сохраняем ответ ассистента в историю (если это текстовый запрос)
-            if not has_image:
-                bot.update_history(message.channel.id, "assistant", final_response)
+    # Повторяющиеся вопросы отдаём из кэша без запроса к модели
+    cache_key = None
+    cached = None
+    if bot.cache is not None:
+        context = bot.recent_turns(channel_id, RESPONSE_CACHE_CONTEXT_TURNS) + [("user", user_text)]
+        if has_image:
+            # Картинки различаем по хэшу содержимого
+            context += [("image", image.digest) for image in images]
+            cache_key = bot.cache.make_key(MODEL, VISION_PROMPT, context)
         else:
-            error_msg = data.get("error", "Неверный формат ответа от API.")
-            print(f"Ошибка API: {error_msg}")
-            try:
-                await message.add_reaction('❌')
-                await message.reply(f"Произошла ошибка при обработке запроса: {error_msg}")
-            except discord.Forbidden:
-                print("Нет разрешения отправить ответ или добавить реакцию.")
-            return
+            cache_key = bot.cache.make_key(MODEL, SAFETY_PROMPT, context)
+        cached = bot.cache.get(cache_key)
+        if cached is not None:
+            print(f"Ответ найден в кэше (канал {channel_id})")
+
+    # Выполняем запрос через общий асинхронный клиент (потоково или целиком)
+    if cached is not None:
+        final_response = await deliver_response(message, cached)
+    elif STREAM_RESPONSES:
+        final_response = await stream_completion(message, payload, cache_key)
     else:
+        final_response = await request_completion(message, payload, cache_key)
+
+    if final_response is None:
+        return "failed"
+
+    # Ставим ответ бота в очередь на запись в Supabase
+    with span.phase("supabase_save"):
+        bot.save_to_supabase(
+            channel_id,
+            bot.user.id,
+            final_response,
+            True
+        )
+
+    # Реплика попадает в историю только вместе с ответом
+    bot.update_history(channel_id, "user", history_text)
+    bot.update_history(channel_id, "assistant", final_response)
+    return "cached" if cached is not None else "ok"
+
+async def reply_api_error(message: Message, text: str):
+    """Отмечает сообщение реакцией ❌ и сообщает об ошибке API."""
+    try:
+        await message.add_reaction('❌')
+        await message.reply(text)
+    except discord.Forbidden:
+        print("Нет разрешения отправить ответ или добавить реакцию.")
+
+async def reply_blocked(message: Message):
+    try:
+        await message.reply("Не могу ответить на этот вопрос (контент запрещён).")
+    except discord.Forbidden:
+        print("Нет разрешения отправить ответ.")
+
+async def reply_empty(message: Message):
+    print("Не удалось получить непустой ответ от API.")
+    try:
+        await message.add_reaction('⚠')
+        await message.reply("Я получил пустой ответ от API. Пожалуйста, попробуйте переформулировать вопрос.")
+    except discord.Forbidden:
+        print("Нет разрешения отправить ответ или добавить реакцию.")
+
+async def request_completion(message: Message, payload: dict, cache_key: str = None):
+    """
+    Запрашивает ответ целиком и отправляет его.
+    Возвращает отправленный текст или None, если ответа не было.
+    """
+    response = await bot.api.complete(payload)
+
+    if not response or response.status_code != 200:
         error_status = "Нет ответа от API" if not response else f"Статус код: {response.status_code}"
         error_text = "Нет ответа" if not response else response.text[:100] + "..." if len(response.text) > 100 else response.text
         print(f"Не удалось получить ответ от API. {error_status}. Ответ: {error_text}")
+        await reply_api_error(message, f"Ошибка соединения с API. {error_status}")
+        return None
+
+    data = response.json()
+    if "choices" not in data:
+        error_msg = data.get("error", "Неверный формат ответа от API.")
+        print(f"Ошибка API: {error_msg}")
+        await reply_api_error(message, f"Произошла ошибка при обработке запроса: {error_msg}")
+        return None
+
+    bot.record_usage(message, data.get("model") or payload["model"], data.get("usage"))
+    raw_response = strip_think(data['choices'][0]['message']['content'] or "")
+    final_response = await deliver_response(message, raw_response)
+    if final_response is not None and cache_key:
+        bot.cache.put(cache_key, raw_response)
+    return final_response
+
+async def deliver_response(message: Message, raw_response: str):
+    """
+    Проверяет, форматирует и отправляет готовый ответ модели (в том числе из кэша).
+    Возвращает отправленный текст или None.
+    """
+    # Проверяем контент ответа
+    if bot.deep_content_check(raw_response):
+        await reply_blocked(message)
+        return None
+
+    # Форматируем ответ
+    started = time.perf_counter()
+    parts = await bot.format_response(raw_response)
+    record_phase("format", time.perf_counter() - started)
+    if not parts:
+        await reply_empty(message)
+        return None
+
+    started = time.perf_counter()
+    await message.reply(parts[0])
+    for part in parts[1:]:
+        await message.channel.send(part)
+    record_phase("discord_send", time.perf_counter() - started)
+    return "\n".join(parts)
+
+class StreamingReply:
+    """
+    Показывает ответ по мере генерации: первое сообщение отправляется после
+    первого предложения, дальше оно редактируется не чаще STREAM_EDIT_INTERVAL.
+    Текст проходит strip_think и ResponseFormatter; когда часть заполняется,
+    она дописывается окончательно, и ответ продолжается новым сообщением.
+    Перед каждой отправкой весь текст проверяется deep_content_check.
+    """
+
+    SENTENCE_END = re.compile(r'[.!?…](\s|$)|\n')
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.stripper = ThinkStripper()
+        self.formatter = ResponseFormatter()
+        self.text = ""
+        self.parts = []
+        self.sent: discord.Message = None
+        self.last: discord.Message = None
+        self.shown = ""
+        self.blocked = False
+        self.truncated = False
+        self._next_edit = 0.0
+
+    @property
+    def overflow(self) -> bool:
+        """Отправлено MAX_RESPONSE_MESSAGES частей — дальше читать поток бессмысленно."""
+        return len(self.parts) >= MAX_RESPONSE_MESSAGES
+
+    async def feed(self, chunk: str):
+        visible = self.stripper.feed(chunk)
+        if not visible:
+            return
+        self.text += visible
+        started = time.perf_counter()
+        parts = self.formatter.feed(visible)
+        record_phase("format", time.perf_counter() - started)
+        for part in parts:
+            if self.overflow:
+                self.truncated = True
+                return
+            if not await self._commit(part):
+                return
+        if self.sent is not None and asyncio.get_running_loop().time() < self._next_edit:
+            return
+        preview = self.formatter.preview()
+        if self.overflow:
+            # Места больше нет: любой следующий текст уже не поместится
+            self.truncated = bool(preview)
+            return
+        if self.sent is None:
+            if not self.SENTENCE_END.search(preview) and len(preview) < STREAM_FIRST_CHUNK_CHARS:
+                return
+        await self._show(preview)
+
+    async def finish(self):
+        """Дописывает оставшиеся части. Возвращает весь отправленный текст или None."""
+        visible = self.stripper.finish()
+        self.text += visible
+        if self.blocked:
+            return None
+        for part in self.formatter.feed(visible) + self.formatter.finish():
+            if self.overflow:
+                self.truncated = True
+                break
+            if not await self._commit(part):
+                return None
+        if self.truncated and self.parts:
+            # Последнюю часть помечаем как оборванную
+            await self._edit_last(self.parts[-1] + "...")
+        if not self.parts:
+            if self.sent is None:
+                await reply_empty(self.message)
+            return None
+        return "\n".join(self.parts)
+
+    async def fail(self, text: str):
+        """Ошибка посреди потока: правим уже отправленное сообщение или отвечаем заново."""
+        if self.sent is None and not self.parts:
+            await reply_api_error(self.message, text)
+            return
+        try:
+            if self.sent is None:
+                await self._send(f"❌ {text}")
+            else:
+                await self.sent.edit(content=f"{self.shown}\n\n❌ {text}"[-MAX_RESPONSE_LENGTH:])
+        except discord.HTTPException as e:
+            print(f"Не удалось отредактировать ответ: {e}")
+
+    def _check(self) -> bool:
+        """Проверяет весь полученный текст; True, если ответ заблокирован."""
+        self.blocked = bot.deep_content_check(self.text)
+        return self.blocked
+
+    async def _refuse(self):
+        refusal = "Не могу ответить на этот вопрос (контент запрещён)."
+        try:
+            if self.sent is None:
+                await self._send(refusal)
+            else:
+                await self.sent.edit(content=refusal)
+        except discord.HTTPException:
+            print("Нет разрешения отправить ответ.")
+
+    async def _send(self, text: str) -> discord.Message:
+        """Первая часть — ответом на сообщение, остальные — следом в канал."""
+        if not self.parts and self.sent is None:
+            return await self.message.reply(text)
+        return await self.message.channel.send(text)
+
+    async def _edit_last(self, text: str):
+        if self.last is None:
+            return
         try:
-            await message.add_reaction('❌')
-            await message.reply(f"Ошибка соединения с API. {error_status}")
-        except discord.Forbidden:
-            print("Нет разрешения отправить ответ или добавить реакцию.")
+            await self.last.edit(content=text)
+        except discord.HTTPException as e:
+            print(f"Не удалось отредактировать ответ: {e}")
+
+    async def _commit(self, part: str) -> bool:
+        """Окончательно показывает заполненную часть; следующая пойдёт новым сообщением."""
+        if not await self._show(part):
+            return False
+        self.parts.append(part)
+        self.last, self.sent = self.sent, None
+        self.shown = ""
+        return True
+
+    async def _show(self, text: str) -> bool:
+        """Отправляет или правит текущее сообщение. False, если ответ заблокирован."""
+        if self._check():
+            await self._refuse()
+            return False
+        if not text or text == self.shown:
+            return True
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            if self.sent is None:
+                self.sent = await self._send(text)
+            else:
+                await self.sent.edit(content=text)
+            self.shown = text
+        except discord.HTTPException as e:
+            print(f"Не удалось отправить часть ответа: {e}")
+        # Если Discord притормозил нас лимитами, следующую правку откладываем сильнее
+        elapsed = loop.time() - started
+        record_phase("discord_send", elapsed)
+        self._next_edit = loop.time() + max(STREAM_EDIT_INTERVAL, elapsed * 2)
+        return True
+
+async def stream_completion(message: Message, payload: dict, cache_key: str = None):
+    """
+    Запрашивает ответ потоком и показывает его по мере генерации.
+    Возвращает окончательный текст или None, если ответа не было.
+    """
+    reply = StreamingReply(message)
+    usage = {}
+    try:
+        async with contextlib.aclosing(bot.api.complete_stream(payload, usage)) as chunks:
+            async for chunk in chunks:
+                await reply.feed(chunk)
+                if reply.blocked or reply.truncated:
+                    break
+    except OpenRouterError as e:
+        error_text = e.text[:100] + "..." if len(e.text) > 100 else e.text
+        print(f"Не удалось получить ответ от API. {e}. Ответ: {error_text}")
+        await reply.fail(f"Ошибка соединения с API. {e}")
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError, RuntimeError) as e:
+        # Обрыв соединения посреди потока aiohttp выдаёт как RuntimeError("Connection closed.")
+        print(f"Ошибка потокового запроса: {e!r}")
+        await reply.fail("Ошибка соединения с API. Нет ответа от API")
+        return None
+    finally:
+        # usage приходит последним фрагментом; при досрочном обрыве потока его нет,
+        # но токены всё равно оплачены — учитываем их по оценке, чтобы они шли в квоту
+        if usage:
+            bot.record_usage(message, usage.pop("model"), usage)
+        elif reply.text:
+            bot.record_usage(message, payload["model"], {
+                "prompt_tokens": estimate_prompt_tokens(payload["messages"]),
+                "completion_tokens": estimate_tokens(reply.text),
+            })
+
+    if reply.blocked:
+        return None
+    final_response = await reply.finish()
+    if final_response is not None and cache_key and not reply.truncated:
+        bot.cache.put(cache_key, reply.text.strip())
+    return final_response
 
 # Функция для запуска Flask-сервера
 def run_flask_app():
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
 
-# Функция для запуска Discord-бота
-def run_discord_bot():
-    # Проверяем наличие необходимых переменных окружения
+# Проверяем наличие необходимых переменных окружения
+def check_environment():
     if not DISCORD_TOKEN:
         print("ОШИБКА: Токен Discord не найден в переменных окружения Render.com")
         exit(1)
@@ -375,18 +2925,169 @@ def run_discord_bot():
         print("ОШИБКА: ID треда не найден в переменных окружения Render.com")
         exit(1)
 
-    # Добавляем информацию о запуске обычного бота
-    print("Попытка подключения обычного Discord бота")
+# Функция для запуска Discord-бота
+def run_discord_bot():
+    check_environment()
+
+    # Добавляем информацию о запуске бота
+    if isinstance(bot, commands.AutoShardedBot):
+        print(f"Попытка подключения Discord бота, шарды: {bot.shard_ids or 'все'} из {bot.shard_count or 'авто'}")
+    else:
+        print("Попытка подключения обычного Discord бота")
     
     # Запуск бота
     bot.run(DISCORD_TOKEN)
 
-# Запускаем оба процесса в разных потоках
+def shutdown_bot():
+    """
+    Штатно закрывает бота на его цикле событий: SafetyBot.close дописывает очереди Supabase.
+    Вызывается из обработчика SIGTERM.
+    """
+    loop = bot.loop
+    if not isinstance(loop, asyncio.AbstractEventLoop) or not loop.is_running():
+        sys.exit(0)
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        # Сигнал пришёл в поток самого цикла (рабочий процесс): ждать здесь нельзя,
+        # bot.run вернётся сам, когда close завершится
+        loop.call_soon_threadsafe(lambda: loop.create_task(bot.close()))
+        return
+    future = asyncio.run_coroutine_threadsafe(bot.close(), loop)
+    try:
+        future.result(timeout=SHUTDOWN_TIMEOUT)
+        print("Бот остановлен")
+    except Exception as e:
+        print(f"Бот не остановился штатно за {SHUTDOWN_TIMEOUT:.0f} с: {e!r}")
+    sys.exit(0)
+
+def install_shutdown_handler(shutdown):
+    """Вызывает shutdown по SIGTERM, которым Render останавливает сервис."""
+    def handle_sigterm(signum, frame):
+        print("Получен SIGTERM, останавливаемся")
+        shutdown()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+def worker_name(shard_ids: list) -> str:
+    return f"{shard_ids[0]}-{shard_ids[-1]}" if len(shard_ids) > 1 else str(shard_ids[0])
+
+def run_shard_worker(shard_ids: list, shard_count: int, status, worker_metrics):
+    """Рабочий процесс: свой бот со своим диапазоном шардов и своим состоянием каналов."""
+    global bot, SHARD_STATUS, WORKER_METRICS, WORKER_NAME
+    SHARD_STATUS = status
+    WORKER_METRICS = worker_metrics
+    WORKER_NAME = worker_name(shard_ids)
+    bot = create_bot(shard_ids, shard_count)
+    install_shutdown_handler(shutdown_bot)
+    run_discord_bot()
+
+def split_shards(shard_count: int, workers: int) -> list:
+    """Делит шарды на непрерывные диапазоны по процессам."""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for index in range(workers):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+def spawn_worker(shard_ids: list, shard_count: int) -> multiprocessing.Process:
+    process = multiprocessing.Process(
+        target=run_shard_worker,
+        args=(list(shard_ids), shard_count, SHARD_STATUS, WORKER_METRICS),
+        daemon=True
+    )
+    process.start()
+    return process
+
+def supervise_workers(processes: dict, shard_count: int):
+    """
+    Перезапускает упавшие рабочие процессы с растущей задержкой. Каждый перезапуск —
+    новый IDENTIFY в Discord, поэтому процесс, который раз за разом падает сразу после
+    старта (неверный токен, нет переменных окружения), в итоге больше не запускается.
+    """
+    started = {shard_ids: time.monotonic() for shard_ids in processes}
+    fast_failures = {shard_ids: 0 for shard_ids in processes}
+    restart_at = {}
+    while processes and not SHUTTING_DOWN.is_set():
+        time.sleep(1)
+        now = time.monotonic()
+        for shard_ids, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            if shard_ids not in restart_at:
+                lived = now - started[shard_ids]
+                fast_failures[shard_ids] = fast_failures[shard_ids] + 1 if lived < WORKER_FAST_EXIT else 0
+                if fast_failures[shard_ids] >= WORKER_MAX_FAST_FAILURES:
+                    print(f"ОШИБКА: процесс шардов {list(shard_ids)} падает сразу после запуска "
+                          f"{fast_failures[shard_ids]} раз подряд (код {process.exitcode}), больше не перезапускаем")
+                    del processes[shard_ids]
+                    continue
+                delay = min(WORKER_RESTART_BACKOFF * 2 ** fast_failures[shard_ids], WORKER_RESTART_BACKOFF_MAX)
+                restart_at[shard_ids] = now + delay
+                print(f"Процесс шардов {list(shard_ids)} завершился (код {process.exitcode}), "
+                      f"перезапуск через {delay:.0f} с")
+            if now >= restart_at[shard_ids] and not SHUTTING_DOWN.is_set():
+                del restart_at[shard_ids]
+                started[shard_ids] = now
+                processes[shard_ids] = spawn_worker(shard_ids, shard_count)
+    if not SHUTTING_DOWN.is_set():
+        print("ОШИБКА: не осталось ни одного рабочего процесса")
+
+def stop_shard_workers(processes: dict):
+    """Передаёт SIGTERM рабочим процессам и ждёт, пока они закроют ботов и допишут очереди."""
+    SHUTTING_DOWN.set()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for process in list(processes.values()):
+        if process.is_alive():
+            process.terminate()
+    for shard_ids, process in list(processes.items()):
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"Процесс шардов {list(shard_ids)} не остановился за {SHUTDOWN_TIMEOUT:.0f} с")
+            process.kill()
+    sys.exit(0)
+
+def start_shard_workers():
+    """Запускает процессы с шардами и отдаёт их общее состояние приложению /health и /metrics."""
+    global SHARD_STATUS, WORKER_METRICS
+    check_environment()
+    if SHARD_COUNT <= 0:
+        print("ОШИБКА: для RUN_MODE=multiprocess нужно указать SHARD_COUNT")
+        exit(1)
+
+    manager = multiprocessing.Manager()
+    SHARD_STATUS = manager.dict()
+    WORKER_METRICS = manager.dict()
+    processes = {}
+    for shard_ids in split_shards(SHARD_COUNT, WORKER_PROCESSES):
+        process = spawn_worker(shard_ids, SHARD_COUNT)
+        processes[tuple(shard_ids)] = process
+        print(f"Запущен процесс {process.pid} для шардов {shard_ids}")
+
+    supervisor = threading.Thread(target=supervise_workers, args=(processes, SHARD_COUNT))
+    supervisor.daemon = True
+    supervisor.start()
+    install_shutdown_handler(lambda: stop_shard_workers(processes))
+
+# Запускаем бота и Flask-сервер
 if __name__ == '__main__':
-    # Создаем и запускаем поток для Discord-бота
-    discord_thread = threading.Thread(target=run_discord_bot)
-    discord_thread.daemon = True
-    discord_thread.start()
+    if RUN_MODE == "multiprocess":
+        # Шарды в отдельных процессах, здесь только сводное приложение /health
+        start_shard_workers()
+    else:
+        if RUN_MODE == "sharded":
+            bot = create_bot(parse_shard_ids(SHARD_IDS) or None, SHARD_COUNT or None, sharded=True)
+
+        # Создаем и запускаем поток для Discord-бота
+        discord_thread = threading.Thread(target=run_discord_bot)
+        discord_thread.daemon = True
+        discord_thread.start()
+        # Без обработчика SIGTERM процесс умирает сразу и очереди Supabase теряются
+        install_shutdown_handler(shutdown_bot)
     
     # Запускаем Flask-сервер в основном потоке
     run_flask_app()
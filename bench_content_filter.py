@@ -0,0 +1,72 @@
+"""
+Бенчмарк фильтра контента: стоимость проверки одного сообщения при 10 000 правил.
+
+Запуск:
+    python bench_content_filter.py [число_правил] [число_сообщений]
+
+Сравнивает автомат ContentFilter с одной большой регуляркой-альтернацией,
+которую пришлось бы строить при старом подходе с CONTENT_FILTERS.
+"""
+import random
+import re
+import sys
+import time
+
+from ai import ContentFilter
+
+ALPHABET = "абвгдежзийклмнопрстуфхцчшщыьэюя"
+
+
+def random_word(rng: random.Random, low: int, high: int) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(low, high)))
+
+
+def build_rules(rng: random.Random, count: int) -> dict:
+    terms = {}
+    for index in range(count):
+        terms.setdefault(f"rule_{index % 50}", []).append(random_word(rng, 5, 12))
+    return {"terms": terms, "command_prefixes": "*#+", "max_mentions": 5}
+
+
+def build_messages(rng: random.Random, count: int) -> list:
+    messages = []
+    for _ in range(count):
+        words = [random_word(rng, 2, 9) for _ in range(rng.randint(10, 60))]
+        messages.append(" ".join(words).capitalize() + ".")
+    return messages
+
+
+def measure(label: str, check, messages: list) -> float:
+    started = time.perf_counter()
+    hits = sum(1 for text in messages if check(text))
+    elapsed = time.perf_counter() - started
+    per_message = elapsed / len(messages) * 1e6
+    print(f"{label:<28} {per_message:10.1f} мкс/сообщение   совпадений: {hits}")
+    return per_message
+
+
+def main():
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(42)
+    rules = build_rules(rng, rule_count)
+    messages = build_messages(rng, message_count)
+    average_length = sum(len(text) for text in messages) / len(messages)
+    print(f"Правил: {rule_count}, сообщений: {message_count}, средняя длина: {average_length:.0f} символов")
+
+    started = time.perf_counter()
+    content_filter = ContentFilter(rules)
+    print(f"Сборка автомата: {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    words = [word for group in rules["terms"].values() for word in group]
+    started = time.perf_counter()
+    alternation = re.compile(r'\b(' + "|".join(map(re.escape, words)) + r')', flags=re.IGNORECASE)
+    print(f"Сборка регулярки: {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    measure("ContentFilter (ответ)", content_filter.check, messages)
+    measure("ContentFilter (входящее)", lambda text: content_filter.check(text, incoming=True), messages)
+    measure("Регулярка-альтернация", alternation.search, messages)
+
+
+if __name__ == "__main__":
+    main()
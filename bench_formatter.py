@@ -0,0 +1,101 @@
+"""
+Бенчмарк постобработки ответа: стоимость ResponseFormatter на длинных ответах.
+
+Запуск:
+    python bench_formatter.py [повторов]
+
+Сравнивает старый регулярный format_response (вырезал разметку и обрезал
+ответ до одного сообщения) с ResponseFormatter целиком и по фрагментам потока.
+Время на килобайт должно оставаться постоянным с ростом длины ответа.
+"""
+import random
+import re
+import sys
+import time
+
+from ai import MAX_RESPONSE_LENGTH, ResponseFormatter
+
+WORDS = "ответ модели пример разметки текст список код функция значение результат".split()
+
+
+def legacy_format(text: str) -> str:
+    """Прежний format_response — для сравнения."""
+    cleaned = re.sub(r'\*{1,2}|_{1,2}|`{1,3}', '', text)
+    sentences = re.split(r'(?<=[.!?])\s+', cleaned)
+    filtered = []
+    total_length = 0
+    for sentence in sentences:
+        if total_length + len(sentence) < MAX_RESPONSE_LENGTH - 3:
+            filtered.append(sentence)
+            total_length += len(sentence)
+        else:
+            break
+    result = ' '.join(filtered).strip()
+    if len(filtered) != len(sentences):
+        result += "..."
+    return result
+
+
+def build_reply(rng: random.Random, chars: int) -> str:
+    """Ответ с заголовками, списками, выделением, snake_case и блоками кода."""
+    blocks = []
+    length = 0
+    while length < chars:
+        kind = rng.random()
+        if kind < 0.15:
+            block = f"## {rng.choice(WORDS).capitalize()}\n"
+        elif kind < 0.35:
+            block = "\n".join(f"- **{rng.choice(WORDS)}**: {rng.choice(WORDS)}" for _ in range(rng.randint(2, 5))) + "\n"
+        elif kind < 0.5:
+            lines = [f"some_value_{index} = {index} * 2" for index in range(rng.randint(3, 12))]
+            block = "```python\n" + "\n".join(lines) + "\n```\n"
+        else:
+            words = [rng.choice(WORDS) for _ in range(rng.randint(20, 60))]
+            words[rng.randrange(len(words))] = f"*{words[0]}*"
+            words[rng.randrange(len(words))] = f"`{words[1]}_name`"
+            block = " ".join(words).capitalize() + ". " + " ".join(words[:10]) + "!\n"
+        blocks.append(block + "\n")
+        length += len(block) + 1
+    return "".join(blocks)
+
+
+def format_whole(text: str) -> list:
+    formatter = ResponseFormatter()
+    return formatter.feed(text) + formatter.finish()
+
+
+def format_stream(text: str, step: int = 12) -> list:
+    formatter = ResponseFormatter()
+    parts = []
+    for index, start in enumerate(range(0, len(text), step)):
+        parts += formatter.feed(text[start:start + step])
+        # StreamingReply правит сообщение не на каждом фрагменте
+        if index % 10 == 0:
+            formatter.preview()
+    return parts + formatter.finish()
+
+
+def measure(label: str, function, text: str, repeats: int):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        result = function(text)
+    elapsed = (time.perf_counter() - started) / repeats
+    parts = len(result) if isinstance(result, list) else 1
+    per_kb = elapsed / (len(text) / 1024) * 1e6
+    print(f"  {label:<26} {elapsed * 1000:9.2f} мс  {per_kb:8.1f} мкс/КиБ   сообщений: {parts}")
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rng = random.Random(42)
+    for chars in (2_000, 20_000, 200_000):
+        text = build_reply(rng, chars)
+        assert format_whole(text) == format_stream(text)
+        print(f"Ответ {len(text)} символов:")
+        measure("старый format_response", legacy_format, text, repeats)
+        measure("ResponseFormatter", format_whole, text, repeats)
+        measure("ResponseFormatter (поток)", format_stream, text, max(1, repeats // 4))
+
+
+if __name__ == "__main__":
+    main()
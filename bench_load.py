@@ -0,0 +1,461 @@
+"""
+Офлайн-нагрузочный тест бота: on_message с фальшивыми Discord, OpenRouter и Supabase.
+
+Генерирует синтетические упоминания (текст, картинки, длинная история) с заданной
+интенсивностью по многим каналам и серверам, прогоняет их через настоящий on_message
+и печатает пропускную способность, p50/p95/p99 по фазам и пиковую память.
+
+Запуск:
+    python bench_load.py --rate 50 --duration 20 --channels 200 --image-ratio 0.1 --history 400
+    python bench_load.py --latency 1.5 --error-rate 0.1 --error-status 429 --stream
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+# Бот читает настройки при импорте, поэтому окружение готовим заранее
+os.environ.setdefault("MODEL", "bench/model")
+os.environ.setdefault("OPENROUTER_API_KEY", "bench-key")
+os.environ.pop("SUPABASE_URL", None)
+os.environ.pop("SUPABASE_KEY", None)
+
+import ai  # noqa: E402
+from fake_openrouter import FakeOpenRouter, FakeProfile  # noqa: E402
+
+
+# --- Фальшивый Supabase ---
+
+class InMemoryResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class InMemoryQuery:
+    """Цепочка вызовов postgrest (insert/select/eq/order/limit/execute) над списком строк."""
+
+    def __init__(self, store, table: str, latency: float):
+        self.store = store
+        self.table = table
+        self.latency = latency
+        self._insert = None
+        self._filters = []
+        self._order = None
+        self._limit = None
+
+    def insert(self, rows):
+        self._insert = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def select(self, *columns):
+        return self
+
+    def eq(self, column, value):
+        self._filters.append((column, value))
+        return self
+
+    def order(self, column, desc=False):
+        self._order = (column, desc)
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def execute(self):
+        # Вызывается из рабочего потока, как настоящий клиент
+        time.sleep(self.latency)
+        with self.store.lock:
+            rows = self.store.tables.setdefault(self.table, [])
+            if self._insert is not None:
+                rows.extend(self._insert)
+                return InMemoryResult(self._insert)
+            selected = [row for row in rows if all(row.get(c) == v for c, v in self._filters)]
+        if self._order:
+            column, desc = self._order
+            selected.sort(key=lambda row: row.get(column, ""), reverse=desc)
+        if self._limit is not None:
+            selected = selected[:self._limit]
+        return InMemoryResult(selected)
+
+
+class InMemorySupabase:
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def table(self, name: str):
+        return InMemoryQuery(self, name, self.latency)
+
+
+# --- Фальшивый Discord ---
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, discord: "FakeDiscord", channel_id: int):
+        self.discord = discord
+        self.id = channel_id
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content: str):
+        await asyncio.sleep(self.discord.latency)
+        self.discord.sends += 1
+        return FakeSentMessage(self.discord, content)
+
+
+class FakeAuthor:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = f"User {user_id}"
+        self.bot = False
+
+
+class FakeAttachment:
+    """Вложение-картинка: одна из image_variants сгенерированных картинок с задержкой «CDN»."""
+
+    _images = {}
+
+    def __init__(self, discord: "FakeDiscord", attachment_id: int, variant: int):
+        self.discord = discord
+        self.id = attachment_id
+        self.variant = variant
+        self.filename = f"image{attachment_id}.png"
+        self.url = f"https://cdn.discordapp.invalid/attachments/{variant}/{self.filename}?ex=bench"
+        self.size = 250_000
+
+    @classmethod
+    def render(cls, variant: int) -> bytes:
+        if variant not in cls._images:
+            from PIL import Image
+            image = Image.new("RGB", (2048, 1536), ((variant * 37) % 256, (variant * 91) % 256, 128))
+            output = io.BytesIO()
+            image.save(output, format="PNG")
+            cls._images[variant] = output.getvalue()
+        return cls._images[variant]
+
+    async def read(self) -> bytes:
+        await asyncio.sleep(self.discord.latency)
+        return self.render(self.variant)
+
+
+class FakeSentMessage:
+    def __init__(self, discord: "FakeDiscord", content: str):
+        self.discord = discord
+        self.content = content
+
+    async def edit(self, content: str = None):
+        await asyncio.sleep(self.discord.latency)
+        self.discord.edits += 1
+        self.content = content
+
+
+class FakeMessage:
+    def __init__(self, discord: "FakeDiscord", channel, guild, author, content: str,
+                 attachments=(), mentions=()):
+        self.discord = discord
+        self.channel = channel
+        self.guild = guild
+        self.author = author
+        self.clean_content = content
+        # В исходном тексте Discord упоминания записаны как <@id>
+        for user in mentions:
+            content = content.replace(f"@{user.name}", f"<@{user.id}>")
+        self.content = content
+        self.attachments = list(attachments)
+        self.mentions = list(mentions)
+        self.created = time.perf_counter()
+
+    @property
+    def raw_mentions(self) -> list:
+        return [user.id for user in self.mentions]
+
+    @property
+    def raw_role_mentions(self) -> list:
+        return []
+
+    async def reply(self, content: str):
+        await asyncio.sleep(self.discord.latency)
+        self.discord.replies += 1
+        self.discord.reply_latencies.append(time.perf_counter() - self.created)
+        return FakeSentMessage(self.discord, content)
+
+    async def add_reaction(self, emoji: str):
+        await asyncio.sleep(self.discord.latency)
+        self.discord.reactions[emoji] = self.discord.reactions.get(emoji, 0) + 1
+
+
+class FakeBotUser:
+    """Пользователь бота: считается упомянутым, если он есть в message.mentions."""
+    id = 1
+    name = "bench-bot"
+
+    def mentioned_in(self, message) -> bool:
+        return self in message.mentions
+
+
+class FakeDiscord:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.replies = 0
+        self.sends = 0
+        self.edits = 0
+        self.reactions = {}
+        self.reply_latencies = []
+
+
+# --- Нагрузка ---
+
+QUESTIONS = [
+    "Какие правила на сервере?",
+    "Как пользоваться командами бота?",
+    "Объясни, как работает форматирование в Discord.",
+    "Посоветуй, как написать хорошее резюме.",
+    "Что такое асинхронное программирование?",
+]
+
+
+def long_reply(chars: int) -> str:
+    """Длинный ответ с заголовками, списками, выделением и блоками кода."""
+    blocks = []
+    index = 0
+    while sum(map(len, blocks)) < chars:
+        index += 1
+        blocks.append(f"## Раздел {index}\n\n**Важно:** это *пример* ответа с `кодом` и списком:\n"
+                      "- первый пункт\n- второй пункт\n\n"
+                      f"```python\nresult_{index} = compute({index})\nprint(result_{index})\n```\n\n")
+    return "".join(blocks)[:chars]
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def seed_history(channels: list, turns: int, rng: random.Random):
+    """Заполняет историю каналов длинной перепиской."""
+    for channel in channels:
+        for index in range(turns):
+            role = "user" if index % 2 == 0 else "assistant"
+            words = " ".join(rng.choice(QUESTIONS) for _ in range(rng.randint(1, 4)))
+            ai.bot.update_history(channel.id, role, words)
+
+
+async def sample_loop_lag(stop: asyncio.Event, samples: list, interval: float = 0.1):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def generate(args, discord: FakeDiscord, rng: random.Random):
+    """Пуассоновский поток упоминаний в случайные каналы."""
+    bot_user = ai.bot.user
+    channels = [FakeChannel(discord, 1000 + index) for index in range(args.channels)]
+    guilds = [FakeGuild(1 + index % args.guilds) for index in range(args.channels)]
+    if args.history:
+        seed_history(channels, args.history, rng)
+
+    sent = 0
+    deadline = time.perf_counter() + args.duration
+    attachment_id = 0
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.expovariate(args.rate))
+        index = rng.randrange(args.channels)
+        attachments = []
+        if rng.random() < args.image_ratio:
+            for _ in range(rng.randint(1, args.max_images)):
+                attachment_id += 1
+                attachments.append(FakeAttachment(discord, attachment_id, rng.randrange(args.image_variants)))
+        message = FakeMessage(
+            discord,
+            channels[index],
+            guilds[index],
+            FakeAuthor(10_000 + rng.randrange(args.users)),
+            f"@{bot_user.name} {rng.choice(QUESTIONS)}",
+            attachments=attachments,
+            mentions=[bot_user],
+        )
+        await ai.on_message(message)
+        sent += 1
+    return sent
+
+
+async def wait_idle(timeout: float):
+    deadline = time.perf_counter() + timeout
+    while (ai.bot.scheduler.pending or ai.bot.scheduler.active) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def cancel_unfinished() -> int:
+    """
+    Отменяет реплики, не завершившиеся за --drain-timeout, чтобы не закрывать клиент
+    OpenRouter и очереди Supabase под работающими запросами. Возвращает их число.
+    """
+    scheduler = ai.bot.scheduler
+    unfinished = scheduler.pending + scheduler.active
+    workers = list(scheduler._workers.values())
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    return unfinished
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    profile = FakeProfile(
+        latency=args.latency,
+        jitter=args.latency * 0.3,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+    )
+    if args.reply_chars:
+        profile.reply = long_reply(args.reply_chars)
+    server = FakeOpenRouter(profile, seed=args.seed)
+    endpoint = await server.start()
+
+    # Подменяем внешние зависимости бота
+    discord = FakeDiscord(args.discord_latency)
+    database = InMemorySupabase(args.supabase_latency)
+    ai.supabase = database
+    ai.STREAM_RESPONSES = args.stream
+    ai.bot._connection.user = FakeBotUser()
+    ai.bot.api = ai.OpenRouterClient(endpoint, "bench-key", concurrency=args.concurrency)
+    ai.bot.writer = ai.SupabaseWriter(database)
+    ai.bot.usage_writer = ai.SupabaseWriter(database, table=ai.USAGE_TABLE)
+    if not args.rate_limits:
+        # Без флага нагрузка не упирается в ограничитель частоты
+        ai.bot.rate_limiter = ai.RateLimiter({})
+    await ai.bot.api.start()
+    ai.bot.writer.start()
+    ai.bot.usage_writer.start()
+
+    # Картинки генерируем заранее, чтобы их создание не мерилось как задержка цикла бота
+    if args.image_ratio > 0:
+        for variant in range(args.image_variants):
+            FakeAttachment.render(variant)
+
+    spans = []
+    ai.SPAN_LISTENERS.append(lambda span, outcome, total: spans.append((dict(span.phases), outcome, total)))
+
+    lag_samples = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(sample_loop_lag(stop, lag_samples))
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    # Логи бота при нагрузке только мешают — глушим их
+    with contextlib.redirect_stdout(io.StringIO()):
+        sent = await generate(args, discord, rng)
+        await wait_idle(args.drain_timeout)
+        elapsed = time.perf_counter() - started
+        processed = len(spans)
+        unfinished = await cancel_unfinished()
+        # Отменённые реплики тоже закрывают span (с итогом error) — в отчёт их не берём
+        del spans[processed:]
+        await ai.bot.writer.close()
+        await ai.bot.usage_writer.close()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stop.set()
+    await lag_task
+    await ai.bot.api.close()
+    await server.stop()
+
+    report(args, sent, elapsed, unfinished, spans, discord, server, database, lag_samples, peak_memory)
+
+
+def report(args, sent, elapsed, unfinished, spans, discord, server, database, lag_samples, peak_memory):
+    outcomes = {}
+    phases = {}
+    totals = []
+    for span_phases, outcome, total in spans:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        totals.append(total)
+        for name, seconds in span_phases.items():
+            phases.setdefault(name, []).append(seconds)
+
+    print(f"Упоминаний отправлено: {sent} за {args.duration:.0f} с по {args.channels} каналам")
+    print(f"Реплик обработано: {len(spans)}  ({len(spans) / elapsed:.1f}/с), итоги: {outcomes}")
+    if unfinished:
+        print(f"Не завершено за {args.drain_timeout:.0f} с и отменено: {unfinished}")
+    print(f"Ответов: {discord.replies}, продолжений: {discord.sends}, правок: {discord.edits}, "
+          f"реакций: {discord.reactions}")
+    print(f"Запросов к OpenRouter: {server.requests} (ошибок: {server.errors})")
+    print(f"Строк в Supabase: {sum(len(rows) for rows in database.tables.values())}")
+    print(f"Токены OpenRouter: {ai.bot.usage.prompt_tokens} prompt / {ai.bot.usage.completion_tokens} completion, "
+          f"отклонено лимитами: {ai.bot.rate_limiter.rejected}")
+    print(f"История: {len(ai.bot.conversation_history)} каналов, "
+          f"{ai.bot.conversation_history.total_bytes / 1024:.0f} КиБ, "
+          f"вытеснено: {ai.bot.conversation_history.evictions}")
+    print(f"Картинки: кэш {ai.bot.vision.hits} попаданий / {ai.bot.vision.misses} промахов, "
+          f"{ai.bot.vision.cache_bytes / 1024:.0f} КиБ")
+    print(f"Пиковая память (tracemalloc): {peak_memory / 1024 / 1024:.1f} МиБ")
+    if lag_samples:
+        print(f"Задержка цикла событий: p99 {percentile(lag_samples, 0.99) * 1000:.1f} мс, "
+              f"макс {max(lag_samples) * 1000:.1f} мс")
+    print()
+    print(f"{'фаза':<24}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'n':>8}")
+    rows = sorted(phases.items()) + [("total", totals), ("reply_latency", discord.reply_latencies)]
+    for name, values in rows:
+        print(f"{name:<24}"
+              f"{percentile(values, 0.50) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}"
+              f"{percentile(values, 0.99) * 1000:>10.2f}"
+              f"{len(values):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-нагрузочный тест on_message")
+    parser.add_argument("--rate", type=float, default=20.0, help="упоминаний в секунду")
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность нагрузки, секунды")
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--image-ratio", type=float, default=0.0, help="доля упоминаний с картинками")
+    parser.add_argument("--max-images", type=int, default=3)
+    parser.add_argument("--image-variants", type=int, default=20, help="различных картинок (повторы попадают в кэш)")
+    parser.add_argument("--history", type=int, default=0, help="реплик истории на канал перед стартом")
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка фальшивого OpenRouter")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы")
+    parser.add_argument("--rate-limits", action="store_true", help="включить ограничитель частоты из RATE_LIMIT_*")
+    parser.add_argument("--reply-chars", type=int, default=0, help="длина ответа модели с разметкой (0 — короткий)")
+    parser.add_argument("--concurrency", type=int, default=ai.OPENROUTER_MAX_CONCURRENCY)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--supabase-latency", type=float, default=0.02)
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
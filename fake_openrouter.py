@@ -0,0 +1,146 @@
+"""
+Локальный фальшивый сервер OpenRouter для проверки бота без платного ключа.
+
+Отвечает на POST /api/v1/chat/completions в формате OpenRouter (обычный JSON
+или SSE при "stream": true) с настраиваемой задержкой и профилем ошибок.
+
+Запуск:
+    python fake_openrouter.py --port 8080 --latency 0.5 --error-rate 0.2 --error-status 429
+    OPENROUTER_ENDPOINT=http://127.0.0.1:8080/api/v1/chat/completions python ai.py
+"""
+import argparse
+import asyncio
+import json
+import random
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+COMPLETIONS_PATH = "/api/v1/chat/completions"
+
+
+@dataclass
+class FakeProfile:
+    """Поведение фальшивого сервера."""
+    latency: float = 0.2           # средняя задержка до первого байта, секунды
+    jitter: float = 0.1            # разброс задержки, секунды
+    error_rate: float = 0.0        # доля запросов, завершающихся ошибкой
+    error_status: int = 503        # HTTP-статус ошибки
+    retry_after: float = None      # значение Retry-After для ошибок
+    fail_models: list = field(default_factory=list)  # модели, которые всегда отвечают ошибкой
+    chunk_delay: float = 0.02      # пауза между SSE-фрагментами
+    chunk_size: int = 12           # длина SSE-фрагмента в символах
+    reply: str = "Это тестовый ответ. Он состоит из нескольких предложений. Всё работает."
+    prompt_tokens: int = 100
+    completion_tokens: int = 20
+
+
+class FakeOpenRouter:
+    """aiohttp-приложение фальшивого OpenRouter со счётчиками запросов."""
+
+    def __init__(self, profile: FakeProfile = None, seed: int = None):
+        self.profile = profile or FakeProfile()
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.models = []
+        self.app = web.Application()
+        self.app.router.add_post(COMPLETIONS_PATH, self.handle)
+        self._runner = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает адрес эндпоинта completions."""
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{bound_port}{COMPLETIONS_PATH}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _delay(self) -> float:
+        profile = self.profile
+        return max(0.0, profile.latency + self.random.uniform(-profile.jitter, profile.jitter))
+
+    def _error(self) -> web.Response:
+        self.errors += 1
+        headers = {}
+        if self.profile.retry_after is not None:
+            headers["Retry-After"] = str(self.profile.retry_after)
+        body = {"error": {"code": self.profile.error_status, "message": "Фальшивая ошибка"}}
+        return web.json_response(body, status=self.profile.error_status, headers=headers)
+
+    def _usage(self) -> dict:
+        return {
+            "prompt_tokens": self.profile.prompt_tokens,
+            "completion_tokens": self.profile.completion_tokens,
+            "total_tokens": self.profile.prompt_tokens + self.profile.completion_tokens,
+        }
+
+    async def handle(self, request: web.Request):
+        payload = await request.json()
+        self.requests += 1
+        model = payload.get("model")
+        self.models.append(model)
+        await asyncio.sleep(self._delay())
+
+        if model in self.profile.fail_models or self.random.random() < self.profile.error_rate:
+            return self._error()
+
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": f"fake-{self.requests}",
+                "model": model,
+                "choices": [{"message": {"role": "assistant", "content": self.profile.reply}}],
+                "usage": self._usage(),
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        text = self.profile.reply
+        try:
+            await response.prepare(request)
+            await response.write(b": OPENROUTER PROCESSING\n\n")
+            for start in range(0, len(text), self.profile.chunk_size):
+                chunk = {"choices": [{"delta": {"content": text[start:start + self.profile.chunk_size]}}]}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await asyncio.sleep(self.profile.chunk_delay)
+            final = {"choices": [{"delta": {}, "finish_reason": "stop"}], "usage": self._usage()}
+            await response.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # Клиент оборвал поток (ответ заблокирован или не помещается) — это не ошибка
+            pass
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фальшивый сервер OpenRouter")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--fail-model", action="append", default=[])
+    args = parser.parse_args()
+
+    profile = FakeProfile(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        fail_models=args.fail_model,
+    )
+    server = FakeOpenRouter(profile)
+    print(f"Фальшивый OpenRouter: http://{args.host}:{args.port}{COMPLETIONS_PATH}")
+    web.run_app(server.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()